@@ -10,6 +10,12 @@ def ratioFloat (string):
         raise argparse.ArgumentTypeError('Value of a ration has to be between 0 and 1.')
     return value
 
+def positiveInt (string):
+    value = int(string)
+    if value < 1:
+        raise argparse.ArgumentTypeError('Value has to be a positive integer.')
+    return value
+
 class _HelpAction(argparse._HelpAction):
 
     def __call__(self, parser, namespace, values, option_string=None):
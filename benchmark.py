@@ -0,0 +1,197 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# offline benchmark of the segmentation pipeline on synthetic field-like frames (soil texture with green
+# plant blobs) at several resolutions and superpixel counts. Every stage is timed on its own, repeated, and
+# the minimum and median times are written to JSON; 'compare' flags the stages slower than in a baseline
+
+import superpixels_dot
+import superpixels_otsu
+import superpixels_backend
+import pipeline
+
+from scipy import ndimage
+from timeit import default_timer as timer
+from functools import partial
+
+import argparse
+import datetime
+import json
+import numpy
+import platform
+import sys
+
+def synthetic_frame(width, height, seed = 0, plants = 40):
+    # 8-bit rgb frame: brown soil with a smoothed texture, and green plant blobs (noisy ellipses of random
+    # shade) scaled with the frame, so that the default 40 plants cover about a fifth of it at any resolution
+    rng = numpy.random.RandomState(seed)
+    texture = ndimage.gaussian_filter(rng.normal(0, 1, (height, width)), 2.0)
+    texture /= numpy.abs(texture).max()
+    soil = numpy.array([120, 90, 60], dtype = numpy.float64)
+    frame = soil + 30 * texture[..., numpy.newaxis] + rng.normal(0, 6, (height, width, 3))
+
+    rows, cols = numpy.mgrid[0:height, 0:width]
+    size = 0.05 * min(width, height)
+    for plant in xrange(plants):
+        row, col = rng.uniform(0, height), rng.uniform(0, width)
+        a, b = rng.uniform(0.5, 1.5, 2) * size
+        angle = rng.uniform(0, numpy.pi)
+        y, x = rows - row, cols - col
+        u = (x * numpy.cos(angle) + y * numpy.sin(angle)) / a
+        v = (-x * numpy.sin(angle) + y * numpy.cos(angle)) / b
+        leaf = u * u + v * v <= 1
+        shade = rng.uniform(0.7, 1.1)
+        green = numpy.array([60, 150, 50], dtype = numpy.float64) * shade
+        frame[leaf] = green + rng.normal(0, 10, (numpy.count_nonzero(leaf), 3))
+
+    return numpy.clip(frame, 0, 255).astype(numpy.uint8)
+
+def time_stage(function, repeat, setup = None):
+    # (minimum, median) wall time of function() over the repeats, setup() run untimed before each
+    times = []
+    for run in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = timer()
+        function()
+        times.append(timer() - start)
+    return min(times), float(numpy.median(times))
+
+def benchmark_frame(frame, n_segments, repeat, verbose = False):
+    # list of (stage, minimum, median, superpixels) for one frame and superpixel count
+    indexer = pipeline.FrameIndexer('CIVE')
+    invert = indexer.invert
+    image = frame / 255.0
+    results = []
+
+    def stage(name, function, setup = None):
+        best, median = time_stage(function, repeat, setup)
+        results.append((name, best, median))
+        if verbose:
+            sys.stderr.write("{:<24} {:>10.2f} ms {:>10.2f} ms\n".format(name, 1000 * best, 1000 * median))
+
+    stage('index', lambda: indexer.index_image(image))
+    image_gray_norm, image_ubyte = indexer.index_image(image)
+
+    backend = superpixels_backend.SlicBackend(n_segments)
+    stage('slic', lambda: backend.segment(image_gray_norm))
+    labels = backend.segment(image_gray_norm)
+
+    # the sequence backend from the lattice (cold) and seeded with the frame's own superpixels, on the frame
+    # moved by a few pixels (warm)
+    sequence = superpixels_backend.SequenceSlicBackend(n_segments)
+    moved = numpy.roll(image_gray_norm, 3, axis = 1)
+    stage('sequence_cold', lambda: sequence.segment(image_gray_norm), setup = partial(setattr, sequence, 'previous', None))
+    stage('sequence_warm', lambda: sequence.segment(moved), setup = partial(sequence.segment, image_gray_norm))
+
+    stage('superpixels_histograms', lambda: superpixels_dot.superpixels_histograms(image_ubyte, labels))
+    stats = superpixels_dot.SuperpixelStats(image_ubyte, labels)
+
+    models = [('average_dot_array', superpixels_dot.average_dot_array),
+              ('median_dot_array', superpixels_dot.median_dot_array),
+              ('k_percent_dot_array', partial(superpixels_dot.k_percent_dot_array, k = 0.7))]
+    for name, dot_function in models:
+        stage(name, lambda: dot_function(stats.histograms, invert = invert))
+    dot = stats.dot(superpixels_dot.average_dot_array, invert)
+
+    stage('otsu_core', lambda: superpixels_otsu.otsu_core(stats, dot, invert))
+    stage('otsu_reduced_core', lambda: superpixels_otsu.otsu_reduced_core(stats, dot, invert))
+    # the percentage events are cached in the statistics, the sweep is timed with them
+    stage('otsu_percentage_sweep', lambda: superpixels_otsu.otsu_percentage_sweep(stats, invert), setup = stats.events.clear)
+    threshold = superpixels_otsu.otsu_core(stats, dot, invert)[1]
+    out = numpy.empty(labels.shape, dtype = numpy.uint8)
+    stage('otsu_mask', lambda: superpixels_otsu.otsu_mask(stats, dot, threshold, invert, out = out))
+
+    return [(name, best, median, len(stats)) for name, best, median in results]
+
+def run(args):
+    results = []
+    sizes = args['size'] or [(320, 240), (640, 480), (1280, 960)]
+    segments = args['segments'] or [1000, 5000, 35000]
+    for width, height in sizes:
+        frame = synthetic_frame(width, height, args['seed'])
+        for n_segments in segments:
+            if args['verbose']:
+                sys.stderr.write("# {}x{}, {} segments\n".format(width, height, n_segments))
+            for stage, best, median, superpixels in benchmark_frame(frame, n_segments, args['repeat'], args['verbose']):
+                results.append({'width': width, 'height': height, 'segments': n_segments, 'superpixels': superpixels, 'stage': stage, 'min': best, 'median': median})
+
+    import skimage
+    import scipy
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'scipy': scipy.__version__,
+            'skimage': skimage.__version__,
+            'platform': platform.platform(),
+            'repeat': args['repeat'],
+            'seed': args['seed']},
+        'results': results}
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            json.dump(report, f, indent = 1, sort_keys = True)
+    else:
+        json.dump(report, sys.stdout, indent = 1, sort_keys = True)
+        print
+
+def compare(args):
+    # stages whose minimum time grew by more than the tolerance (and by more than --min-delta) are regressions
+    with open(args['baseline']) as f:
+        baseline = json.load(f)
+    with open(args['current']) as f:
+        current = json.load(f)
+    key = lambda result: (result['width'], result['height'], result['segments'], result['stage'])
+    reference = dict((key(result), result) for result in baseline['results'])
+
+    regressions = 0
+    print("{:<12} {:>8} {:<24} {:>12} {:>12} {:>8}".format('size', 'segments', 'stage', 'baseline ms', 'current ms', 'ratio'))
+    for result in current['results']:
+        base = reference.get(key(result))
+        if base is None:
+            continue
+        ratio = result['min'] / base['min'] if base['min'] > 0 else float('inf')
+        slower = ratio > 1 + args['tolerance'] and result['min'] - base['min'] > args['min_delta'] / 1000.0
+        faster = ratio < 1 - args['tolerance'] and base['min'] - result['min'] > args['min_delta'] / 1000.0
+        regressions += slower
+        print("{:<12} {:>8} {:<24} {:>12.2f} {:>12.2f} {:>8.2f} {}".format("{}x{}".format(result['width'], result['height']), result['segments'], result['stage'], 1000 * base['min'], 1000 * result['min'], ratio, 'REGRESSION' if slower else 'faster' if faster else ''))
+
+    print("# {} regressions (tolerance {:.0%})".format(regressions, args['tolerance']))
+    return 1 if regressions else 0
+
+def size(value):
+    try:
+        width, height = [int(part) for part in value.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not a size WIDTHxHEIGHT".format(value))
+    return width, height
+
+def main():
+
+    ap = argparse.ArgumentParser(description = "Benchmark the stages of the segmentation pipeline on synthetic frames, and compare the results with a baseline.")
+    subparsers = ap.add_subparsers(dest = 'command')
+
+    run_parser = subparsers.add_parser('run', help = "Run the benchmark and write the results as JSON.")
+    run_parser.add_argument("-o", "--output", required = False, help = "JSON file for the results. Printed to stdout by default.")
+    run_parser.add_argument("--size", required = False, help = "Frame size WIDTHxHEIGHT (can be repeated). 320x240, 640x480 and 1280x960 by default.", action = "append", type = size)
+    run_parser.add_argument("--segments", required = False, help = "Number of SLIC segments (can be repeated). 1000, 5000 and 35000 by default.", action = "append", type = int)
+    run_parser.add_argument("--repeat", required = False, help = "Number of timed runs of each stage", default = 5, type = int)
+    run_parser.add_argument("--seed", required = False, help = "Seed of the synthetic frames", default = 0, type = int)
+    run_parser.add_argument("-v", "--verbose", required = False, help = "Print the times while running, to stderr", action = "store_true")
+
+    compare_parser = subparsers.add_parser('compare', help = "Compare benchmark results with a baseline, exiting with status 1 on regressions.")
+    compare_parser.add_argument("baseline", help = "JSON results of the baseline")
+    compare_parser.add_argument("current", help = "JSON results to check")
+    compare_parser.add_argument("-t", "--tolerance", required = False, help = "Relative slowdown of the minimum time tolerated", default = 0.1, type = float)
+    compare_parser.add_argument("--min-delta", required = False, help = "Slowdowns under this many milliseconds are not flagged", default = 0.5, type = float)
+
+    args = vars(ap.parse_args())
+
+    if args['command'] == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,199 @@
 #!/usr/local/bin/python
 # -*- coding: utf-8 -*-
 
-import common # for normalize_rgb
+import collections
+import numpy
 
-def linear_combination_index(point_rgb, normalize = False, rw = 1.0, gw = 1.0, bw = 1.0):
+# index registry: an index is declared as rgb weights, an offset and optional ratio terms
+# weight * r^n_r g^n_g b^n_b / (r^d_r g^d_g b^d_b), where a denominator <= small is replaced by scale * numerator.
+# invert marks indices for which vegetation has low values (thresholding keeps the values below T).
+# each index is evaluated by a kernel function over the (optionally normalized) r, g, b arrays, made once per index
+# (the single-stage float32 kernel is color_index_fused.FusedIndex)
+
+Ratio = collections.namedtuple('Ratio', 'weight, numerator, denominator, small, scale')
+IndexDefinition = collections.namedtuple('IndexDefinition', 'weights, offset, ratios, invert')
+
+INDICES = collections.OrderedDict()
+KERNELS = {}
+
+def register_index(name, weights = (0.0, 0.0, 0.0), offset = 0.0, ratios = (), invert = False):
+    INDICES[name] = IndexDefinition(weights = tuple(weights), offset = offset, ratios = tuple(ratios), invert = invert)
+    KERNELS.pop(name, None)
+    return INDICES[name]
+
+def power_terms(exponents):
+    # (channel, exponent) of the channels of a ratio's numerator or denominator, without the zero exponents
+    return [(channel, exponent) for channel, exponent in enumerate(exponents) if exponent != 0]
+
+def power_product(channels, terms):
+    product = None
+    for channel, exponent in terms:
+        term = channels[channel] if exponent == 1 else channels[channel] ** exponent
+        product = term if product is None else product * term
+    return 1.0 if product is None else product
+
+def linear_kernel(linear, offset):
+    # indices without ratio terms: the weighted channels and the offset summed in place
+    (first, first_weight), rest = linear[0], linear[1:]
+
+    def kernel(r, g, b):
+        channels = (r, g, b)
+        total = first_weight * channels[first]
+        for channel, weight in rest:
+            total += weight * channels[channel]
+        if offset != 0:
+            total += offset
+        return total
+
+    return kernel
+
+def ratio_kernel(linear, ratios, offset):
+    # the linear terms, then every ratio term, then the offset, in the order they are declared
+    def kernel(r, g, b):
+        channels = (r, g, b)
+        total = None
+        for channel, weight in linear:
+            term = weight * channels[channel]
+            total = term if total is None else total + term
+        for ratio, numerator_terms, denominator_terms in ratios:
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                numerator = power_product(channels, numerator_terms)
+                denominator = power_product(channels, denominator_terms)
+                value = numpy.where(denominator <= ratio.small, numerator * ratio.scale, numerator / denominator)
+            if ratio.weight != 1:
+                value = ratio.weight * value
+            total = value if total is None else total + value
+        if offset != 0:
+            total = offset if total is None else total + offset
+        return 0.0 * r if total is None else total
+
+    return kernel
+
+def index_kernel(index):
+    # function of the r, g, b arrays evaluating the definition, with its terms resolved once per index
+    if index not in KERNELS:
+        definition = INDICES[index]
+        linear = [(channel, weight) for channel, weight in enumerate(definition.weights) if weight != 0]
+        if linear and not definition.ratios:
+            KERNELS[index] = linear_kernel(linear, definition.offset)
+        else:
+            ratios = [(ratio, power_terms(ratio.numerator), power_terms(ratio.denominator)) for ratio in definition.ratios]
+            KERNELS[index] = ratio_kernel(linear, ratios, definition.offset)
+    return KERNELS[index]
+
+def index_choices():
+    # index names accepted on the command line; the 'n' prefix selects normalized rgb (for indices with linear terms)
+    choices = []
+    for name, definition in INDICES.items():
+        choices.append(name)
+        if any(definition.weights):
+            choices.append('n' + name)
+    return choices
+
+def parse_index_name(name):
+    if name in INDICES:
+        return name, False
+    if name[:1] == 'n' and name[1:] in INDICES and any(INDICES[name[1:]].weights):
+        return name[1:], True
+    raise ValueError("Unknown color index '{}'.".format(name))
+
+register_index('CIVE', weights = (0.441, -0.811, 0.385), offset = 18.78745, invert = True)
+register_index('ExG', weights = (-1.0, 2.0, -1.0))
+register_index('ExR', weights = (1.3, -1.0, 0))
+register_index('mExG', weights = (-0.884, 1.262, -0.311))
+register_index('VEG', ratios = [Ratio(weight = 1.0, numerator = (0, 1, 0), denominator = (0.667, 0, 1 - 0.667), small = 1e-3, scale = 1e3)])
+
+# array versions: work on an HxWx3 (or Nx3) rgb array and return the index image in one pass
+
+def rgb_channels(img_rgb, normalize = False):
+    img_rgb = numpy.asarray(img_rgb)
+    if img_rgb.dtype.kind != 'f':
+        img_rgb = img_rgb.astype(numpy.float64)
+    r, g, b = img_rgb[..., 0], img_rgb[..., 1], img_rgb[..., 2]
     if normalize:
-        point_rgb = common.normalize_rgb(point_rgb)
-    return rw * getattr(point_rgb, 'r', point_rgb[0]) + gw * getattr(point_rgb, 'g', point_rgb[1]) + bw * getattr(point_rgb, 'b', point_rgb[2]) 
+        # black pixels normalize to (0, 0, 0) instead of 0 / 0
+        sum_all = r + g + b
+        sum_all = numpy.where(sum_all > 0, sum_all, 1.0)
+        r, g, b = r / sum_all, g / sum_all, b / sum_all
+    return r, g, b
+
+def linear_combination_index_array(img_rgb, normalize = False, rw = 1.0, gw = 1.0, bw = 1.0):
+    r, g, b = rgb_channels(img_rgb, normalize)
+    return rw * r + gw * g + bw * b
+
+def index_array(img_rgb, index, normalize = False):
+    return index_kernel(index)(*rgb_channels(img_rgb, normalize))
+
+def index_arrays(img_rgb, indices, normalize = False):
+    # several indices in one pass: the channels (and their normalization) are shared
+    r, g, b = rgb_channels(img_rgb, normalize)
+    return [index_kernel(index)(r, g, b) for index in indices]
+
+def excess_green_array(img_rgb, normalize = False):
+    return index_array(img_rgb, 'ExG', normalize)
+
+def modified_excess_green_array(img_rgb, normalize = False):
+    return index_array(img_rgb, 'mExG', normalize)
+
+def excess_red_array(img_rgb, normalize = False):
+    return index_array(img_rgb, 'ExR', normalize)
+
+def CIVE_array(img_rgb, normalize = False):
+    return index_array(img_rgb, 'CIVE', normalize)
+
+def VEG_array(img_rgb, normalize = False):
+    # normalize is ignored, as by the original per-point VEG
+    return index_array(img_rgb, 'VEG')
+
+def combination_array(img_rgb):
+    exg, cive, veg = index_arrays(img_rgb, ['ExG', 'CIVE', 'VEG'])
+    return 0.36 * exg + 0.47 * cive + 0.17 * veg
+
+# per-point versions (accept Point_rgb, pandas rows or any [r, g, b] sequence)
+
+def point_array(point_rgb):
+    return numpy.array([getattr(point_rgb, 'r', point_rgb[0]), getattr(point_rgb, 'g', point_rgb[1]), getattr(point_rgb, 'b', point_rgb[2])])
+
+def linear_combination_index(point_rgb, normalize = False, rw = 1.0, gw = 1.0, bw = 1.0):
+    return linear_combination_index_array(point_array(point_rgb), normalize, rw, gw, bw)[()]
 #    return rw * point_rgb.r + gw * point_rgb.g + bw * point_rgb.b
 
 def excess_green(point_rgb, normalize = False):
-    return linear_combination_index(point_rgb, normalize, rw = -1.0, gw = 2.0, bw = -1.0)
+    return excess_green_array(point_array(point_rgb), normalize)[()]
 
 def modified_excess_green(point_rgb, normalize = False):
-    return linear_combination_index(point_rgb, normalize, rw = -0.884, gw = 1.262, bw = -0.311)
+    return modified_excess_green_array(point_array(point_rgb), normalize)[()]
 
 def excess_red(point_rgb, normalize = False):
-    return linear_combination_index(point_rgb, normalize, rw = 1.3, gw = -1.0, bw = 0)
+    return excess_red_array(point_array(point_rgb), normalize)[()]
 
 def CIVE(point_rgb, normalize = False):
-    return linear_combination_index(point_rgb, normalize, rw = 0.441, gw = -0.811, bw = 0.385) + 18.78745
+    return CIVE_array(point_array(point_rgb), normalize)[()]
 
 def VEG(point_rgb, normalize = False):
-    a = 0.667
-    denominator = getattr(point_rgb, 'r', point_rgb[0]) ** a * getattr(point_rgb, 'b', point_rgb[2]) ** (1-a)
-    if denominator <= 1e-3:
-        return getattr(point_rgb, 'g', point_rgb[1]) * 1e3
-    else:
-        return getattr(point_rgb, 'g', point_rgb[1]) / denominator
+    return VEG_array(point_array(point_rgb), normalize)[()]
 
 def combination(point_rgb):
-    return 0.36 * excess_green(point_rgb) + 0.47 * CIVE(point_rgb) + 0.17 * VEG(point_rgb)
+    return combination_array(point_array(point_rgb))[()]
+
+# quantization of index images (same result as exposure.rescale_intensity followed by img_as_ubyte)
+
+def rescale_to_ubyte(img_index, in_range = None):
+    if in_range is None:
+        in_range = (img_index.min(), img_index.max())
+    imin, imax = in_range
+    scaled = (numpy.clip(img_index, imin, imax) - imin) / float(imax - imin)
+    if imin < 0: # rescale_intensity maps to [-1, 1] when the index has negative values, negative half is clipped
+        scaled = scaled * 2 - 1
+    scaled *= 255
+    numpy.rint(scaled, out = scaled)
+    numpy.clip(scaled, 0, 255, out = scaled)
+    return scaled.astype(numpy.uint8)
+
+def rescale_to_levels(img_index, in_range):
+    # img_index over in_range in 256 levels, without clipping the negative half: level 0 is in_range[0] and
+    # level 255 is in_range[1]
+    imin, imax = in_range
+    scaled = (numpy.clip(img_index, imin, imax) - imin) * (255.0 / (imax - imin))
+    numpy.rint(scaled, out = scaled)
+    return scaled.astype(numpy.uint8)
@@ -0,0 +1,117 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# single stage from an 8-bit rgb image to the quantized (uint8) color index image, rescaled to the
+# image's own range like exposure.rescale_intensity + img_as_ubyte, and to the rescaled float image
+# before the quantization, for the superpixel backends. Uses float32 arithmetic and
+# buffers that are reused between frames of the same size, instead of four float64 temporaries.
+# Results can differ from the float64 path by one graylevel for values on a rounding boundary.
+
+import color_index # for the index registry
+import numpy
+
+class FusedIndex(object):
+
+    def __init__(self, index, normalize = False):
+        definition = color_index.INDICES[index]
+        self.normalize = normalize
+        self.offset = definition.offset
+        self.shape = None
+        # per-channel tables replace the uint8 -> float conversion (and the powers of ratio terms)
+        values = numpy.arange(256, dtype = numpy.float32) / numpy.float32(255)
+        self.sum_tables = [(channel, values) for channel in xrange(3)]
+        self.linear = [(channel, values * numpy.float32(weight)) for channel, weight in enumerate(definition.weights) if weight != 0]
+        self.ratios = []
+        for ratio in definition.ratios:
+            if normalize and sum(ratio.numerator) != sum(ratio.denominator):
+                raise ValueError("Normalized ratio terms of index '{}' need numerator and denominator of the same degree.".format(index))
+            numerator = [(channel, values ** numpy.float32(exponent)) for channel, exponent in enumerate(ratio.numerator) if exponent != 0]
+            denominator = [(channel, values ** numpy.float32(exponent)) for channel, exponent in enumerate(ratio.denominator) if exponent != 0]
+            self.ratios.append((ratio, sum(ratio.numerator), numerator, denominator))
+
+    def allocate(self, shape):
+        self.shape = shape
+        self.buffer = numpy.empty(shape, dtype = numpy.float32)
+        self.temp = numpy.empty(shape, dtype = numpy.float32)
+        if self.normalize:
+            self.norm = numpy.empty(shape, dtype = numpy.float32)
+        if self.ratios:
+            self.numerator = numpy.empty(shape, dtype = numpy.float32)
+            self.denominator = numpy.empty(shape, dtype = numpy.float32)
+        self.out = numpy.empty(shape, dtype = numpy.uint8)
+
+    def gather(self, channels, tables, out, temp, product = False):
+        # sum (or product) of per-channel table lookups
+        if not tables:
+            out.fill(1)
+            return out
+        numpy.take(tables[0][1], channels[tables[0][0]], out = out)
+        for channel, table in tables[1:]:
+            numpy.take(table, channels[channel], out = temp)
+            if product:
+                out *= temp
+            else:
+                out += temp
+        return out
+
+    def index_image(self, img_rgb):
+        if self.shape != img_rgb.shape[:2]:
+            self.allocate(img_rgb.shape[:2])
+        buf, temp = self.buffer, self.temp
+        channels = (img_rgb[..., 0], img_rgb[..., 1], img_rgb[..., 2])
+        if self.normalize:
+            norm = self.gather(channels, self.sum_tables, self.norm, temp)
+            # black pixels normalize to (0, 0, 0) instead of 0 / 0, as in color_index.rgb_channels
+            numpy.copyto(norm, 1, where = norm == 0)
+        if self.linear:
+            self.gather(channels, self.linear, buf, temp)
+            if self.normalize:
+                with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                    buf /= norm
+        else:
+            buf.fill(0)
+        for ratio, degree, numerator, denominator in self.ratios:
+            num = self.gather(channels, numerator, self.numerator, temp, product = True)
+            den = self.gather(channels, denominator, self.denominator, temp, product = True)
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                if self.normalize:
+                    # normalization cancels out in the ratio, it only scales the denominator
+                    # tested by the small-denominator branch and the numerator used there
+                    numpy.power(norm, numpy.float32(degree), out = temp)
+                    small = den <= temp * numpy.float32(ratio.small)
+                    numpy.divide(num, den, out = den)
+                    num /= temp
+                else:
+                    small = den <= ratio.small
+                    numpy.divide(num, den, out = den)
+            num *= numpy.float32(ratio.scale)
+            numpy.copyto(den, num, where = small)
+            if ratio.weight != 1:
+                den *= numpy.float32(ratio.weight)
+            buf += den
+        return buf
+
+    def index_images(self, img_rgb, in_range = None):
+        # (index image rescaled like exposure.rescale_intensity, float32, and its quantization, uint8), both in
+        # buffers reused between frames. The float image is the one given to the superpixel backends, in
+        # [-1, 1] when the index has negative values, else in [0, 1]. in_range includes the offset, as the
+        # range of color_index.index_array; the image's own range by default
+        img_index = self.index_image(img_rgb)
+        imin, imax = img_index.min(), img_index.max()
+        # the offset does not change the rescaled image, only whether rescale_intensity maps to [0, 1] or [-1, 1]
+        signed = imin + self.offset < 0
+        if in_range is not None:
+            imin, imax = in_range[0] - self.offset, in_range[1] - self.offset
+            numpy.clip(img_index, imin, imax, out = img_index)
+        img_index -= imin
+        img_index *= numpy.float32((2.0 if signed else 1.0) / (imax - imin))
+        if signed:
+            img_index -= numpy.float32(1)
+        numpy.multiply(img_index, numpy.float32(255), out = self.temp)
+        numpy.rint(self.temp, out = self.temp)
+        numpy.clip(self.temp, 0, 255, out = self.temp)
+        numpy.copyto(self.out, self.temp, casting = 'unsafe')
+        return img_index, self.out
+
+    def __call__(self, img_rgb, in_range = None):
+        return self.index_images(img_rgb, in_range)[1]
@@ -0,0 +1,103 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# lookup tables from 8-bit rgb to the quantized (uint8) color index image. A table is built once for
+# a given index, normalization and fixed quantization range, and cached on disk as a memory-mapped
+# .npy file shared between runs and processes. Indexing a frame is then a single gather.
+# Frames are quantized to this fixed range, not to their own range as in the float and fused paths. By
+# default it is the range of the index over all 8-bit rgb values, which is only usable for indices without
+# ratio terms on raw rgb: for VEG the small-denominator branch spans most of it, and normalized indices
+# only use a fraction of it, so those need an explicit range.
+# The levels tables keep the negative half that the quantization clips, for the float image the
+# superpixel backends segment (see level_values)
+
+import color_index
+import numpy
+import os
+import tempfile
+
+def default_cache_dir():
+    return os.environ.get('PCD_STATS_LUT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pcd-stats', 'lut'))
+
+def lut_chunks(index, normalize = False):
+    # index values for all (g, b) combinations, one red value at a time (65536 values per chunk)
+    from skimage.util import img_as_float
+
+    values = img_as_float(numpy.arange(256, dtype = numpy.uint8))
+    gb = numpy.empty((256, 256, 3))
+    gb[..., 1] = values[:, numpy.newaxis]
+    gb[..., 2] = values[numpy.newaxis, :]
+    for r in xrange(256):
+        gb[..., 0] = values[r]
+        yield r, color_index.index_array(gb, index, normalize)
+
+def index_range(index, normalize = False):
+    imin, imax = numpy.inf, -numpy.inf
+    for r, chunk in lut_chunks(index, normalize):
+        imin = min(imin, numpy.nanmin(chunk))
+        imax = max(imax, numpy.nanmax(chunk))
+    return imin, imax
+
+def needs_range(index, normalize = False):
+    # whether the range over all 8-bit rgb values is degenerate for the index
+    return normalize or bool(color_index.INDICES[index].ratios)
+
+def build_lut(index, normalize = False, in_range = None, out = None, levels = False):
+    if in_range is None:
+        in_range = index_range(index, normalize)
+    if out is None:
+        out = numpy.empty((256, 256, 256), dtype = numpy.uint8)
+    rescale = color_index.rescale_to_levels if levels else color_index.rescale_to_ubyte
+    for r, chunk in lut_chunks(index, normalize):
+        out[r] = rescale(chunk, in_range)
+    return out
+
+def level_values(index, normalize = False, in_range = None):
+    # float32 value of every level of a levels table, the index rescaled like exposure.rescale_intensity: to
+    # [-1, 1] when the range has negative values, else to [0, 1]
+    if in_range is None:
+        in_range = index_range(index, normalize)
+    levels = numpy.arange(256, dtype = numpy.float32) / numpy.float32(255)
+    if in_range[0] < 0:
+        return levels * numpy.float32(2) - numpy.float32(1)
+    return levels
+
+def lut_path(index, normalize = False, in_range = None, cache_dir = None, levels = False):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    name = ('n' if normalize else '') + index
+    if in_range is None:
+        name += '_full'
+    else:
+        name += '_{!r}_{!r}'.format(float(in_range[0]), float(in_range[1]))
+    if levels:
+        name += '_levels'
+    return os.path.join(cache_dir, 'lut_' + name + '.npy')
+
+def load_lut(index, normalize = False, in_range = None, cache_dir = None, verbose = False, levels = False):
+    if in_range is None and needs_range(index, normalize):
+        raise ValueError("The lookup table of color index '{}' needs a quantization range.".format(('n' if normalize else '') + index))
+    path = lut_path(index, normalize, in_range, cache_dir, levels)
+    if not os.path.isfile(path):
+        if verbose:
+            print("Building {} lookup table {}.".format(index, path))
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError: # created concurrently by another process
+                pass
+        # build into a temporary file and rename it, so concurrent readers never see a partial table
+        fd, tmp_path = tempfile.mkstemp(suffix = '.npy', dir = os.path.dirname(path))
+        os.close(fd)
+        lut = numpy.lib.format.open_memmap(tmp_path, mode = 'w+', dtype = numpy.uint8, shape = (256, 256, 256))
+        build_lut(index, normalize, in_range, out = lut, levels = levels)
+        lut.flush()
+        del lut
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    elif verbose:
+        print("Using {} lookup table {}.".format(index, path))
+    return numpy.load(path, mmap_mode = 'r')
+
+def apply_lut(lut, img_rgb):
+    return lut[img_rgb[..., 0], img_rgb[..., 1], img_rgb[..., 2]]
@@ -0,0 +1,213 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# randomized differential test of the accelerated superpixel code against the frozen reference
+# (superpixels_reference.py): random label maps and 8-bit images, with edge cases (constant, saturated,
+# two-valued superpixels that make the median ties, gapped label ids), are run through both, and the
+# histograms, DOTs of every model, variance curves, thresholds, masks and the percentage sweep must be
+# identical. Mismatches are printed with the seed and trial to reproduce them; exits with status 1 on any
+
+import superpixels_dot
+import superpixels_otsu
+import superpixels_reference as reference
+
+from functools import partial
+
+import argparse
+import numpy
+import sys
+
+class ArrayEngine(object):
+    # the numpy implementation used by the scripts
+
+    def stats(self, image, labels):
+        return superpixels_dot.SuperpixelStats(image, labels)
+
+    def histograms(self, stats):
+        return stats.histograms
+
+    def dot(self, stats, model, k, invert):
+        if model == 'avg':
+            dot_function = superpixels_dot.average_dot_array
+        elif model == 'med':
+            dot_function = superpixels_dot.median_dot_array
+        else:
+            dot_function = partial(superpixels_dot.k_percent_dot_array, k = k)
+        return stats.dot(dot_function, invert)
+
+    def otsu_core(self, stats, dot, invert):
+        return superpixels_otsu.otsu_core(stats, dot, invert)
+
+    def otsu_reduced_core(self, stats, dot, invert):
+        return superpixels_otsu.otsu_reduced_core(stats, dot, invert)
+
+    def otsu_mask(self, stats, dot, threshold, invert):
+        return superpixels_otsu.otsu_mask(stats, dot, threshold, invert)
+
+    def percentage_sweep(self, stats, invert, k_start, k_end):
+        return superpixels_otsu.otsu_percentage_sweep(stats, invert, k_start, k_end)
+
+ENGINES = {'array': ArrayEngine}
+
+MODELS = ['avg', 'med', 'perc']
+
+# ks closer than this are the same event (the accelerated events are within rounding of 1 - ratio)
+K_TOLERANCE = 1e-9
+
+def random_labels(rng, height, width, num_sp):
+    # label map numbered 0..n-1: nearest of num_sp random seeds, or random pixels for scattered superpixels
+    if rng.rand() < 0.2:
+        labels = rng.randint(0, num_sp, (height, width))
+    else:
+        rows, cols = numpy.mgrid[0:height, 0:width]
+        seeds = rng.uniform(0, 1, (num_sp, 2)) * (height, width)
+        distances = (rows[..., numpy.newaxis] - seeds[:, 0])**2 + (cols[..., numpy.newaxis] - seeds[:, 1])**2
+        labels = numpy.argmin(distances, axis = 2)
+    return numpy.unique(labels, return_inverse = True)[1].reshape(height, width)
+
+def random_image(rng, labels):
+    # graylevels drawn per superpixel from one of several distributions, the edge cases included
+    image = numpy.empty(labels.shape, dtype = numpy.uint8)
+    for label in xrange(labels.max() + 1):
+        pixels = labels == label
+        size = numpy.count_nonzero(pixels)
+        kind = rng.randint(7)
+        if kind == 0: # constant
+            values = numpy.full(size, rng.choice([0, 255, rng.randint(256)]))
+        elif kind == 1: # saturated
+            values = rng.choice([0, 255], size)
+        elif kind == 2: # two values, half and half when possible (median tie)
+            values = numpy.sort(rng.choice(256, 2, replace = False))[numpy.arange(size) * 2 // size]
+        elif kind == 3: # narrow
+            values = numpy.clip(rng.normal(rng.randint(256), 3, size), 0, 255)
+        elif kind == 4: # few levels
+            values = rng.choice(rng.randint(0, 256, 3), size)
+        else:
+            values = rng.randint(0, 256, size)
+        image[pixels] = values
+    return image
+
+def gapped_labels(rng, labels):
+    # the same label map with random increasing ids, not numbered 0..n-1
+    ids = numpy.cumsum(rng.randint(1, 4, labels.max() + 1))
+    return ids[labels]
+
+def reference_dot(histograms, model, k, invert):
+    # k_percent_dot skips the superpixels without a threshold, which the accelerated code marks with 256 (-1 when inverted)
+    if model == 'avg':
+        return reference.average_dot(histograms, invert)
+    if model == 'med':
+        return reference.median_dot(histograms, invert)
+    return [(reference.k_percent_dot([hist], k, invert) or [-1 if invert else 256])[0] for hist in histograms]
+
+def reference_events(histograms, invert, k_start, k_end):
+    # distinct ks in [k_start, k_end] at which a DOT of the percentage model changes, with the k below which
+    # no threshold is found
+    ks = [event[0] for event in reference.all_percent_dot(histograms, invert)]
+    for hist in histograms:
+        below = sum(hist[1:]) if invert else sum(hist[:255])
+        ks.append(1 - float(below) / sum(hist))
+    return sorted(set(k for k in ks if k_start + K_TOLERANCE < k < k_end - K_TOLERANCE))
+
+class Checker(object):
+
+    def __init__(self, seed, trial, verbose = False):
+        self.seed = seed
+        self.trial = trial
+        self.verbose = verbose
+        self.checks = 0
+        self.mismatches = 0
+
+    def check(self, name, same, details = ''):
+        self.checks += 1
+        if not same:
+            self.mismatches += 1
+            print("MISMATCH seed={} trial={}: {} {}".format(self.seed, self.trial, name, details))
+        elif self.verbose:
+            print("ok seed={} trial={}: {}".format(self.seed, self.trial, name))
+
+def check_sweep(checker, engine, stats, image, ref_hist, invert, k_start, k_end, rng, samples):
+    name = "sweep invert={} k=[{:.3f}, {:.3f}]".format(invert, k_start, k_end)
+    ks, variances, thresholds = engine.percentage_sweep(stats, invert, k_start, k_end)
+    ref_ks = reference_events(ref_hist, invert, k_start, k_end)
+    inner = [k for k in ks if k_start + K_TOLERANCE < k < k_end - K_TOLERANCE]
+    near = lambda k, others: len(others) > 0 and numpy.min(numpy.abs(numpy.asarray(others) - k)) <= K_TOLERANCE
+    missing = [k for k in ref_ks if not near(k, inner)]
+    extra = [k for k in inner if not near(k, ref_ks)]
+    checker.check(name + " events", not missing and not extra, "missing ks {} extra ks {}".format(missing[:5], extra[:5]))
+
+    # the DOTs, variance and threshold at the visited ks (a sample of them and the best one)
+    if len(ks) == 0:
+        return
+    visited = set(rng.choice(len(ks), min(samples, len(ks)), replace = False))
+    visited.add(int(numpy.argmax(variances)))
+    for i in sorted(visited):
+        dot = reference_dot(ref_hist, 'perc', ks[i], invert)
+        var, thr = reference.otsu_core(image, ref_hist, dot, invert)[:2]
+        checker.check(name + " at k={!r}".format(ks[i]), var == variances[i] and thr == thresholds[i], "reference ({}, {}) engine ({}, {})".format(var, thr, variances[i], thresholds[i]))
+
+def run_trial(engine, seed, trial, args):
+    rng = numpy.random.RandomState([seed, trial])
+    checker = Checker(seed, trial, args['verbose'])
+    height, width = rng.randint(4, args['max_size'] + 1, 2)
+    num_sp = rng.randint(1, min(args['max_superpixels'], height * width) + 1)
+    labels = random_labels(rng, height, width, num_sp)
+    image = random_image(rng, labels)
+    engine_labels = gapped_labels(rng, labels) if rng.rand() < 0.3 else labels
+
+    ref_hist = reference.superpixels_histograms(image, labels)
+    stats = engine.stats(image, engine_labels)
+    checker.check("histograms", numpy.array_equal(engine.histograms(stats), numpy.array(ref_hist)))
+
+    for invert in (False, True):
+        for model in MODELS:
+            k = round(rng.uniform(0.05, 0.95), 3)
+            name = "{} invert={}{}".format(model, invert, " k={}".format(k) if model == 'perc' else '')
+            ref_dot = reference_dot(ref_hist, model, k, invert)
+            dot = engine.dot(stats, model, k, invert)
+            checker.check(name + " dot", numpy.array_equal(dot, ref_dot))
+
+            ref_core = reference.otsu_core(image, ref_hist, ref_dot, invert)
+            core = engine.otsu_core(stats, dot, invert)
+            ref_reduced = reference.otsu_reduced_core(image, ref_dot, invert)
+            reduced = engine.otsu_reduced_core(stats, dot, invert)
+            for core_name, (ref_var, ref_thr, ref_var_all), (var, thr, var_all) in (("core", ref_core, core), ("reduced core", ref_reduced, reduced)):
+                checker.check("{} {} threshold".format(name, core_name), ref_var == var and ref_thr == thr, "reference ({}, {}) engine ({}, {})".format(ref_var, ref_thr, var, thr))
+                checker.check("{} {} variances".format(name, core_name), numpy.array_equal(numpy.array(ref_var_all, dtype = numpy.float64), var_all))
+
+            for threshold in [ref_core[1], ref_reduced[1]] + list(rng.randint(-1, 258, 3)):
+                mask = engine.otsu_mask(stats, dot, threshold, invert)
+                checker.check("{} mask at {}".format(name, threshold), numpy.array_equal(mask, reference.otsu_mask(labels, ref_dot, threshold, invert)))
+
+        k_start, k_end = numpy.sort(rng.uniform(0, 1, 2))
+        check_sweep(checker, engine, stats, image, ref_hist, invert, k_start, k_end, rng, args['sweep_samples'])
+
+    return checker
+
+def main():
+
+    ap = argparse.ArgumentParser(description = "Check an accelerated implementation of the superpixel models and Otsu's method against the frozen reference on random frames.")
+    ap.add_argument("-n", "--trials", required = False, help = "Number of random frames", default = 100, type = int)
+    ap.add_argument("--seed", required = False, help = "Seed of the random frames", default = 0, type = int)
+    ap.add_argument("--trial", required = False, help = "Only run this trial (to reproduce a mismatch)", type = int)
+    ap.add_argument("-e", "--engine", required = False, help = "Implementation checked against the reference", default = "array", choices = sorted(ENGINES))
+    ap.add_argument("--max-size", required = False, help = "Largest frame side, in pixels", default = 40, type = int)
+    ap.add_argument("--max-superpixels", required = False, help = "Largest number of superpixels per frame", default = 60, type = int)
+    ap.add_argument("--sweep-samples", required = False, help = "Number of ks of each percentage sweep checked with the reference", default = 8, type = int)
+    ap.add_argument("-v", "--verbose", required = False, help = "Print every check", action = "store_true")
+    args = vars(ap.parse_args())
+
+    engine = ENGINES[args['engine']]()
+    trials = [args['trial']] if args['trial'] is not None else xrange(args['trials'])
+    checks = 0
+    mismatches = 0
+    for trial in trials:
+        checker = run_trial(engine, args['seed'], trial, args)
+        checks += checker.checks
+        mismatches += checker.mismatches
+
+    print("# {} checks over {} frames, {} mismatches (engine {}, seed {})".format(checks, len(trials), mismatches, args['engine'], args['seed']))
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# content-addressed on-disk cache of the per-frame results that do not depend on the thresholding: the
+# uint8 index image and the superpixel label map. Entries are keyed by a hash of the image file contents
+# and the parameters that produced them, stored as .npy files read back memory-mapped, and evicted least
+# recently used first once the cache grows over its size cap (a hit refreshes the files' modification time)
+
+import hashlib
+import numpy
+import os
+import tempfile
+
+def default_cache_dir():
+    return os.environ.get('PCD_STATS_FRAME_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pcd-stats', 'frames'))
+
+def file_digest(path, chunk_size = 1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FrameCache(object):
+
+    def __init__(self, cache_dir = None, max_bytes = 1 << 30, verbose = False):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError: # created concurrently by another process
+                pass
+
+    def frame_key(self, image_path, *params):
+        return hashlib.sha1((file_digest(image_path) + repr(params)).encode('utf-8')).hexdigest()
+
+    def path(self, key, name):
+        return os.path.join(self.cache_dir, '{}_{}.npy'.format(key, name))
+
+    def load_frame(self, key):
+        # (index image, label map) or None when either is missing
+        paths = [self.path(key, 'index'), self.path(key, 'labels')]
+        if not all(os.path.isfile(path) for path in paths):
+            return None
+        try:
+            arrays = [numpy.load(path, mmap_mode = 'r') for path in paths]
+        except (IOError, ValueError): # evicted or replaced in the meantime
+            return None
+        for path in paths:
+            os.utime(path, None)
+        if self.verbose:
+            print("Index image and superpixels loaded from the cache ({}).".format(key))
+        return arrays
+
+    def store(self, path, array):
+        # written to a temporary file and renamed, so that concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(suffix = '.npy', dir = self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+
+    def store_frame(self, key, image_ubyte, labels):
+        labels = numpy.asarray(labels)
+        # labels are numbered from 0, the smallest unsigned type that holds them is enough
+        label_type = numpy.uint16 if labels.max() < (1 << 16) else numpy.uint32
+        self.store(self.path(key, 'index'), numpy.asarray(image_ubyte, dtype = numpy.uint8))
+        self.store(self.path(key, 'labels'), labels.astype(label_type))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.npy') and os.path.isfile(path):
+                status = os.stat(path)
+                entries.append((status.st_mtime, status.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError: # removed by another process
+                pass
+            total -= size
+            if self.verbose:
+                print("Evicted {} from the cache.".format(path))
+
+def add_arguments(ap):
+    ap.add_argument("--cache", required = False, help = "Cache the index images and superpixels on disk, keyed by image contents and parameters, and reuse them in later runs.", action = "store_true")
+    ap.add_argument("--cache-dir", required = False, help = "Cache directory. Defaults to ~/.cache/pcd-stats/frames or $PCD_STATS_FRAME_CACHE.")
+    ap.add_argument("--cache-size", required = False, help = "Size cap of the cache in MB; least recently used frames are evicted beyond it.", default = 1024, type = float)
+
+def from_args(args, verbose = False):
+    if not args['cache']:
+        return None
+    return FrameCache(args['cache_dir'], int(args['cache_size'] * (1 << 20)), verbose)
@@ -0,0 +1,135 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# watch-folder source of frames for live capture. A polling thread lists the capture directory and puts the
+# new frames, once their size has settled (so that files still being written are not read), on a bounded
+# queue that the consumer iterates over. When the consumer falls behind, the poller either waits for room
+# (backpressure, the frames wait on disk) or drops the oldest queued frame. Only the names still present in
+# the directory are remembered, so memory stays flat however long it runs
+
+import fnmatch
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+POLICIES = ['block', 'drop-oldest']
+
+class FolderWatcher(object):
+
+    def __init__(self, directory, pattern = '*_orig.png', poll = 0.2, queue_size = 8, policy = 'block', existing = False, idle_exit = None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy '{}'.".format(policy))
+        self.directory = directory
+        self.pattern = pattern
+        self.poll = poll
+        self.policy = policy
+        self.idle_exit = idle_exit
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.stopped = threading.Event()
+        # names already queued (or dropped), and size at the last poll of the new ones
+        self.known = set() if existing else set(self.listing())
+        self.pending = {}
+        self.thread = None
+
+    def listing(self):
+        return sorted(name for name in os.listdir(self.directory) if fnmatch.fnmatch(name, self.pattern))
+
+    def poll_once(self):
+        names = self.listing()
+        self.known.intersection_update(names)
+        pending = {}
+        for name in names:
+            if name in self.known:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except OSError: # removed in the meantime
+                continue
+            if size > 0 and self.pending.get(name) == size:
+                self.known.add(name)
+                self.put((os.path.join(self.directory, name), time.time()))
+            else:
+                pending[name] = size
+        self.pending = pending
+
+    def put(self, item):
+        if self.policy == 'block':
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout = self.poll)
+                    return
+                except queue.Full:
+                    pass
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty: # taken by the consumer in the meantime
+                    pass
+
+    def watch(self):
+        while not self.stopped.is_set():
+            self.poll_once()
+            self.stopped.wait(self.poll)
+
+    def start(self):
+        self.thread = threading.Thread(target = self.watch)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __iter__(self):
+        # (image path, time it was queued) in order of arrival, until stopped or idle for idle_exit seconds
+        last = time.time()
+        while not self.stopped.is_set():
+            try:
+                item = self.queue.get(timeout = self.poll)
+            except queue.Empty:
+                if self.idle_exit is not None and time.time() - last > self.idle_exit:
+                    return
+                continue
+            last = time.time()
+            yield item
+
+class Latency(object):
+    # running count, mean and maximum of the per-frame latencies, in constant memory
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+def add_arguments(ap):
+    ap.add_argument("--pattern", required = False, help = "File name pattern of the frames in the watched directory", default = "*_orig.png")
+    ap.add_argument("--poll", required = False, help = "Polling interval of the watched directory, in seconds. A frame is read once its size is unchanged between two polls.", default = 0.2, type = float)
+    ap.add_argument("--queue-size", required = False, help = "Number of frames waiting to be processed before the queue policy applies", default = 8, type = int)
+    ap.add_argument("--policy", required = False, help = "What to do when the queue is full: wait for room (the frames wait on disk) or drop the oldest queued frame", default = "block", choices = POLICIES)
+    ap.add_argument("--existing", required = False, help = "Also process the frames already in the watched directory", action = "store_true")
+    ap.add_argument("--idle-exit", required = False, help = "Stop after this many seconds without new frames. Runs until interrupted by default.", type = float)
+
+def from_args(args):
+    return FolderWatcher(args['watch'], args['pattern'], args['poll'], args['queue_size'], args['policy'], args['existing'], args['idle_exit'])
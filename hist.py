@@ -7,19 +7,23 @@ import matplotlib
 
 import argparse
 
+import results_io
+
 def main():
 
     ap = argparse.ArgumentParser(description = "Display the histogram of thresholds for an image sequence contained in a text file.")
 
-    ap.add_argument("-i", "--input", required = True, help = "Path to the file containing the results of Otsu's thresholding for an image sequence.")
+    ap.add_argument("-i", "--input", required = True, help = "Path to the file containing the results of Otsu's thresholding for an image sequence: the text output of a script, or a structured results file (.csv, .jsonl or .npz).")
+    ap.add_argument("-m", "--method", required = False, help = "Method whose thresholds are shown, from a structured results file with several methods. All of them by default.", choices = ["regular", "sp", "reduced"])
+    ap.add_argument("--raw", required = False, help = "Show the thresholds before the recency correction, from a structured results file.", action = "store_true")
 
     args = vars(ap.parse_args())
 
-    f= np.loadtxt(args["input"], unpack='False')
+    f, methods = results_io.load_thresholds(args["input"], args["method"], 'threshold' if args["raw"] else 'threshold_corrected')
 
     bins = np.linspace(0, 255, 256)
 
-    plt.hist(f, bins, histtype='step', fill = True, rwidth=1)
+    plt.hist(f, bins, histtype='step', fill = True, rwidth=1, label = methods)
     plt.ylabel('Threshold')
     plt.xlabel('Number of images')
     plt.title("Distribution of Otsu's threshold")
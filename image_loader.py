@@ -0,0 +1,84 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# image decoding, optionally prefetched: the next few images of the sequence are decoded in a thread pool
+# (both decoders release the GIL while decoding) while the current frame is processed. At most `prefetch`
+# decoded images are held besides the current one. cv2's decoder is faster than skimage's and gives the
+# same pixels, converted from BGR(A) to RGB(A) order
+
+from multiprocessing.pool import ThreadPool
+
+import collections
+
+DECODERS = ['skimage', 'cv2']
+
+def read_image(image_path, decoder = 'skimage'):
+    if decoder == 'skimage':
+        from skimage import io
+
+        return io.imread(image_path)
+    import cv2
+
+    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError("Cannot read image '{}'.".format(image_path))
+    if img.ndim == 3 and img.shape[2] == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if img.ndim == 3 and img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+    return img
+
+class ImageLoader(object):
+
+    def __init__(self, decoder = 'skimage', prefetch = 0):
+        if decoder not in DECODERS:
+            raise ValueError("Unknown image decoder '{}'.".format(decoder))
+        self.decoder = decoder
+        self.prefetch = prefetch
+        self.pool = ThreadPool(min(prefetch, 4)) if prefetch > 0 else None
+        self.pending = collections.OrderedDict() # image path -> decode in progress, in reading order
+        self.upcoming = iter(())
+
+    def schedule(self, image_paths):
+        # the images to be read next, in order
+        self.pending.clear()
+        self.upcoming = iter(image_paths)
+        self.fill()
+
+    def fill(self):
+        while self.pool is not None and len(self.pending) < self.prefetch:
+            try:
+                image_path = next(self.upcoming)
+            except StopIteration:
+                return
+            if image_path not in self.pending:
+                self.pending[image_path] = self.pool.apply_async(read_image, (image_path, self.decoder))
+
+    def discard(self, image_path):
+        # the image will not be read (its frame came from the cache)
+        if self.pending.pop(image_path, None) is not None:
+            self.fill()
+
+    def __call__(self, image_path):
+        if image_path not in self.pending:
+            return read_image(image_path, self.decoder)
+        # images scheduled before it were not read
+        while True:
+            path, result = self.pending.popitem(last = False)
+            if path == image_path:
+                break
+        self.fill()
+        return result.get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        self.pending.clear()
+
+def add_arguments(ap):
+    ap.add_argument("--prefetch", required = False, help = "Decode up to this many of the next images in background threads while the current one is processed", default = 0, type = int)
+    ap.add_argument("--decoder", required = False, help = "Image decoder. cv2's is faster and gives the same pixels.", default = "skimage", choices = DECODERS)
+
+def from_args(args):
+    return ImageLoader(args.get('decoder', 'skimage'), args.get('prefetch', 0))
@@ -0,0 +1,208 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# saving of the 0/255 masks of -s, in a background thread fed through a bounded queue (the processing loop
+# only waits when more than queue_size masks are pending). Formats:
+#   colormap: pyplot.imsave with the gray colormap, an rgba PNG (the original output)
+#   png8:     single-channel 8-bit PNG written by cv2
+#   png1:     single-channel 1-bit PNG written by cv2 (read back as 0/255)
+#   packbits: appended to a mask sequence file, 1 bit per pixel (numpy.packbits)
+#   rle:      appended to a mask sequence file, as the lengths of the alternating 0 and 255 runs (one byte
+#             per run below 255, longer runs as 255 bytes adding up until a byte below 255)
+# The data of both sequence formats is zlib compressed, which keeps it well below the size of the PNGs.
+# A mask sequence file starts with MAGIC, followed by one record per mask: RECORD (encoding, height, width,
+# length of the name and of the data), the name of the mask (as the PNG would have been named) and the data.
+# Existing sequence files are appended to, so that the batches of a sequence can go to a single file.
+# Nonzero pixels are stored as 255. Run as a script to extract the masks of a sequence file as PNGs
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import argparse
+import numpy
+import os
+import struct
+import threading
+import zlib
+
+FORMATS = ['colormap', 'png8', 'png1', 'packbits', 'rle']
+
+SEQUENCE_FORMATS = {'packbits': b'PACK', 'rle': b'RLE '}
+
+MAGIC = b'PCDMASK1'
+
+RECORD = struct.Struct('<4sIIII')
+
+def write_image(path, mask, mask_format = 'png1'):
+    if mask_format == 'colormap':
+        import plotting
+
+        plotting.imsave(path, mask, cmap = 'gray')
+        return
+    import cv2
+
+    params = [cv2.IMWRITE_PNG_BILEVEL, 1] if mask_format == 'png1' else []
+    if not cv2.imwrite(os.path.splitext(path)[0] + '.png', mask, params):
+        raise IOError("Cannot write mask '{}'.".format(path))
+
+def encode(mask, mask_format):
+    pixels = numpy.asarray(mask).ravel() != 0
+    if mask_format == 'packbits':
+        return zlib.compress(numpy.packbits(pixels).tobytes())
+    # run lengths, starting with a (possibly empty) run of 0
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(pixels[1:] != pixels[:-1]) + 1, [len(pixels)]))
+    runs = numpy.diff(bounds)
+    if len(pixels) and pixels[0]:
+        runs = numpy.concatenate(([0], runs))
+    lengths = runs // 255 + 1
+    data = numpy.full(lengths.sum(), 255, dtype = numpy.uint8)
+    data[numpy.cumsum(lengths) - 1] = runs % 255
+    return zlib.compress(data.tobytes())
+
+def decode(encoding, height, width, data):
+    data = numpy.frombuffer(zlib.decompress(data), dtype = numpy.uint8)
+    if encoding == SEQUENCE_FORMATS['packbits']:
+        pixels = numpy.unpackbits(data)[:height * width].astype(bool)
+    else:
+        ends = numpy.flatnonzero(data != 255)
+        runs = numpy.add.reduceat(data.astype(numpy.int64), numpy.concatenate(([0], ends[:-1] + 1))) if len(ends) else ends
+        pixels = numpy.repeat(numpy.arange(len(runs)) % 2 == 1, runs)
+    return pixels.reshape(height, width).astype(numpy.uint8) * numpy.uint8(255)
+
+class MaskSequence(object):
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise IOError("'{}' is not a mask sequence file.".format(path))
+            self.stream = open(path, 'ab')
+        else:
+            self.stream = open(path, 'wb')
+            self.stream.write(MAGIC)
+
+    def append(self, name, shape, mask_format, data):
+        name = name.encode('utf-8')
+        self.stream.write(RECORD.pack(SEQUENCE_FORMATS[mask_format], shape[0], shape[1], len(name), len(data)))
+        self.stream.write(name)
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.close()
+
+def read_masks(path):
+    # (name, mask) of every mask of a sequence file, in the order they were written
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError("'{}' is not a mask sequence file.".format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            encoding, height, width, name_length, data_length = RECORD.unpack(header)
+            name = f.read(name_length).decode('utf-8')
+            yield name, decode(encoding, height, width, f.read(data_length))
+
+class MaskWriter(object):
+
+    def __init__(self, mask_format = 'colormap', sequence_path = None, queue_size = 16):
+        if mask_format not in FORMATS:
+            raise ValueError("Unknown mask format '{}'.".format(mask_format))
+        self.format = mask_format
+        self.sequence = None
+        if mask_format in SEQUENCE_FORMATS:
+            if not sequence_path:
+                raise ValueError("The {} mask format needs a sequence file.".format(mask_format))
+            self.sequence = MaskSequence(sequence_path)
+        self.error = None
+        self.queue = None
+        self.thread = None
+        if queue_size > 0:
+            self.queue = queue.Queue(queue_size)
+            self.thread = threading.Thread(target = self.work)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def save(self, path, mask):
+        # mask is copied, so its buffer can be reused once this returns
+        self.put((path, numpy.array(mask, dtype = numpy.uint8), None))
+
+    def save_encoded(self, path, shape, data):
+        # a mask already encoded in the sequence format (by the --jobs workers)
+        self.put((path, shape, data))
+
+    def put(self, item):
+        self.check()
+        if self.queue is None:
+            self.write(*item)
+        else:
+            self.queue.put(item)
+
+    def write(self, path, mask, data):
+        if self.sequence is None:
+            write_image(path, mask, self.format)
+            return
+        if data is None:
+            mask, data = mask.shape, encode(mask, self.format)
+        self.sequence.append(os.path.basename(path), mask, self.format, data)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None: # after an error the masks are dropped, it is raised in the main thread
+                try:
+                    self.write(*item)
+                except Exception as error:
+                    self.error = error
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        # waits for the pending masks
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.sequence is not None:
+            self.sequence.close()
+            self.sequence = None
+        self.check()
+
+def add_arguments(ap):
+    ap.add_argument("--mask-format", required = False, help = "Format of the masks saved with -s: the original colormapped rgba PNG, a single-channel 8-bit or 1-bit PNG, or appended to the --mask-sequence file bit-packed or run-length encoded", default = "colormap", choices = FORMATS)
+    ap.add_argument("--mask-sequence", required = False, help = "Mask sequence file of the packbits and rle formats (appended to if it exists)")
+    ap.add_argument("--mask-queue", required = False, help = "Number of masks waiting for the background writer before the processing waits; 0 writes them in the processing loop", default = 16, type = int)
+
+def check_arguments(ap, args):
+    if args['mask_format'] in SEQUENCE_FORMATS and not args['mask_sequence']:
+        ap.error("--mask-format {} needs --mask-sequence.".format(args['mask_format']))
+
+def from_args(args):
+    # the writer of the masks, None without -s
+    if not args['save']:
+        return None
+    return MaskWriter(args['mask_format'], args['mask_sequence'], args['mask_queue'])
+
+def main():
+
+    ap = argparse.ArgumentParser(description = "Extract the masks of a mask sequence file as 8-bit PNG files.")
+    ap.add_argument("sequence", help = "Mask sequence file")
+    ap.add_argument("-o", "--output", required = False, help = "Directory for the PNG files. The masks are only listed without it.")
+    args = vars(ap.parse_args())
+
+    for name, mask in read_masks(args['sequence']):
+        if args['output']:
+            write_image(os.path.join(args['output'], name), mask, 'png8')
+        else:
+            print("{} {}x{} {} accepted".format(name, mask.shape[1], mask.shape[0], numpy.count_nonzero(mask)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# Otsu's thresholding of images too large to hold in memory (stitched orthomosaics), tile by tile with
+# bounded memory. Otsu's method only needs histograms, so the global thresholds come from merging per-tile
+# 256-bin histograms of the quantized index image (regular method) and per-tile threshold buckets of the
+# superpixels (sp and reduced methods). The passes over the image:
+#   range: min and max of the float index image, its quantization range (skipped with a LUT)
+#   index: quantized index, histograms or superpixels, DOTs and buckets of every tile. With masks to write,
+#          the quantized index (regular) or the DOT of every pixel (sp, reduced) is kept in a temporary
+#          memory-mapped file
+#   mask:  masks at the global thresholds, written tile by tile into memory-mapped .npy files
+# .npy files and uncompressed TIFFs are memory-mapped, one band of tile rows at a time so that only the pages
+# of the current tile are resident. Other formats (and compressed or tiled TIFFs) would have to be decoded
+# whole, so they are rejected; such mosaics are converted to .npy first.
+# Superpixels are computed per tile and do not cross tile borders, the --n-segments of the whole image
+# divided among the tiles by area
+
+import superpixels_dot
+import superpixels_otsu
+import pipeline
+import profiling
+
+import copy
+import numpy
+import os
+import tempfile
+
+class Raster(object):
+    # C-ordered array stored in a file at an offset, mapped for each access to the rows of a tile only
+
+    def __init__(self, filename, offset, shape, dtype):
+        self.filename = filename
+        self.offset = offset
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.row_bytes = int(numpy.prod(self.shape[1:])) * self.dtype.itemsize
+
+    def band(self, rows, mode):
+        return numpy.memmap(self.filename, dtype = self.dtype, mode = mode, offset = self.offset + rows.start * self.row_bytes, shape = (rows.stop - rows.start,) + self.shape[1:])
+
+    def read(self, rows, cols):
+        band = self.band(rows, 'r')
+        tile = numpy.array(band[:, cols])
+        del band
+        return tile
+
+    def write(self, rows, cols, values):
+        band = self.band(rows, 'r+')
+        band[:, cols] = values
+        band.flush()
+        del band
+
+def memmap_raster(array):
+    if not isinstance(array, numpy.memmap) or not array.flags.c_contiguous or array.filename is None:
+        return None
+    return Raster(array.filename, array.offset, array.shape, array.dtype)
+
+def open_raster(image_path):
+    extension = os.path.splitext(image_path)[1].lower()
+    raster = None
+    if extension == '.npy':
+        raster = memmap_raster(numpy.load(image_path, mmap_mode = 'r'))
+    elif extension in ('.tif', '.tiff'):
+        try:
+            import tifffile
+        except ImportError: # bundled with skimage < 0.17
+            from skimage.external import tifffile
+
+        if hasattr(tifffile, 'memmap'):
+            try:
+                raster = memmap_raster(tifffile.memmap(image_path, mode = 'r'))
+            except ValueError: # compressed, tiled or not in native byte order
+                pass
+        else:
+            with tifffile.TiffFile(image_path) as tif:
+                raster = memmap_raster(tif.asarray(memmap = True))
+    else:
+        raise ValueError("'{}': only .npy files and uncompressed TIFFs can be read tile by tile.".format(image_path))
+    if raster is None:
+        raise ValueError("'{}' cannot be memory-mapped (compressed, tiled or not C-ordered); convert it to .npy first.".format(image_path))
+    if raster.dtype != numpy.uint8 or len(raster.shape) != 3 or raster.shape[2] not in (3, 4):
+        raise ValueError("'{}' is not an 8-bit rgb image.".format(image_path))
+    return raster
+
+def create_raster(path, shape, dtype):
+    # .npy file of the given shape, readable with numpy.load
+    array = numpy.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+    raster = Raster(path, array.offset, shape, dtype)
+    del array
+    return raster
+
+def tiles(shape, tile_size):
+    # (rows, cols) slices of the tiles, row by row
+    for row in xrange(0, shape[0], tile_size):
+        for col in xrange(0, shape[1], tile_size):
+            yield slice(row, min(row + tile_size, shape[0])), slice(col, min(col + tile_size, shape[1]))
+
+def otsu_histogram(hist):
+    # Otsu's threshold of a 256-bin histogram, computed as cv2.threshold with THRESH_OTSU does on the image
+    scale = 1.0 / sum(int(count) for count in hist)
+    mu = 0.0
+    for i in xrange(256):
+        mu += i * float(hist[i])
+    mu *= scale
+    mu1, q1 = 0.0, 0.0
+    max_sigma, max_val = 0.0, 0
+    epsilon = numpy.finfo(numpy.float32).eps
+    for i in xrange(256):
+        p_i = hist[i] * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < epsilon or max(q1, q2) > 1.0 - epsilon:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+    return max_val
+
+class MosaicFrame(object):
+    # one large image: analyze() merges the tiles into the raw thresholds, write_masks() writes the masks
+    # at the (recency corrected) thresholds, close() removes the temporary files
+
+    def __init__(self, image_path, indexer, methods, backend = None, dot_function = superpixels_dot.average_dot_array, tile_size = 1024, masks = False, tempdir = None):
+        self.image_path = image_path
+        self.indexer = indexer
+        self.methods = methods
+        self.backend = backend
+        self.dot_function = dot_function
+        self.tile_size = tile_size
+        self.raster = open_raster(image_path)
+        self.shape = self.raster.shape[:2]
+        self.backends = {}
+        # superpixels per DOT, from -1 to 256
+        self.dot_counts = numpy.zeros(258, dtype = numpy.int64)
+        self.temporary = {}
+        if masks:
+            # quantized index of the regular method, DOT of every pixel of the superpixel methods
+            maps = [('ubyte', numpy.uint8)] if 'regular' in methods else []
+            if 'sp' in methods or 'reduced' in methods:
+                maps.append(('dot', numpy.int16))
+            for name, dtype in maps:
+                handle, path = tempfile.mkstemp(suffix = '.npy', prefix = 'mosaic_' + name + '_', dir = tempdir)
+                os.close(handle)
+                self.temporary[name] = create_raster(path, self.shape, dtype)
+
+    @profiling.timed('decode')
+    def read(self, rows, cols):
+        return self.indexer.prepare(self.raster.read(rows, cols)[..., :3])
+
+    def tile_backend(self, shape):
+        # copy of the backend with the tile's share of the superpixels (one per tile shape, the grid keeps its lattice)
+        if shape not in self.backends:
+            backend = copy.copy(self.backend)
+            backend.n_segments = max(1, int(round(self.backend.n_segments * shape[0] * shape[1] / float(self.shape[0] * self.shape[1]))))
+            self.backends[shape] = backend
+        return self.backends[shape]
+
+    def index_range(self):
+        imin, imax = numpy.inf, -numpy.inf
+        for rows, cols in tiles(self.shape, self.tile_size):
+            tile_min, tile_max = self.indexer.index_range(self.read(rows, cols))
+            imin, imax = min(imin, tile_min), max(imax, tile_max)
+        return imin, imax
+
+    def analyze(self, verbose = False):
+        # thresholds[method], before the recency correction
+        invert = self.indexer.invert
+        in_range = None
+        if self.indexer.lut is None:
+            in_range = self.index_range()
+            if verbose:
+                print("Index range of {}: [{}, {}]".format(self.image_path, in_range[0], in_range[1]))
+        superpixels = 'sp' in self.methods or 'reduced' in self.methods
+
+        hist = numpy.zeros(256, dtype = numpy.int64)
+        count_buckets = numpy.zeros(256, dtype = numpy.int64)
+        moment_buckets = numpy.zeros(256, dtype = numpy.int64)
+        reduced_counts = numpy.zeros(256, dtype = numpy.int64)
+        sum_all = 0
+        for rows, cols in tiles(self.shape, self.tile_size):
+            image_gray_norm, image_ubyte = self.indexer.index_image(self.read(rows, cols), in_range)
+            if 'regular' in self.methods:
+                with profiling.stage('histogram'):
+                    hist += numpy.bincount(image_ubyte.ravel(), minlength = 256)
+                if 'ubyte' in self.temporary:
+                    self.temporary['ubyte'].write(rows, cols, image_ubyte)
+            if not superpixels:
+                continue
+            with profiling.stage('superpixels'):
+                labels = self.tile_backend(image_gray_norm.shape[:2]).segment(image_gray_norm)
+            stats = superpixels_dot.SuperpixelStats(image_ubyte, labels)
+            dot = stats.dot(self.dot_function, invert)
+            with profiling.stage('otsu'):
+                counts, moments = superpixels_otsu.threshold_buckets(dot, stats.counts, stats.moments)
+                count_buckets += counts
+                moment_buckets += moments
+                sum_all += stats.sum_all
+                reduced_counts += superpixels_otsu.reduced_buckets(dot)[0]
+                self.dot_counts += numpy.bincount(dot + 1, minlength = 258)
+            if 'dot' in self.temporary:
+                with profiling.stage('mask'):
+                    self.temporary['dot'].write(rows, cols, numpy.take(stats.label_lookup(dot.astype(numpy.int16)), labels))
+
+        thresholds = {}
+        with profiling.stage('otsu'):
+            if 'regular' in self.methods:
+                thresholds['regular'] = otsu_histogram(hist)
+            if 'sp' in self.methods:
+                all_var = superpixels_otsu.otsu_variance(self.shape[0] * self.shape[1], sum_all, count_buckets, moment_buckets, invert)
+                thresholds['sp'] = superpixels_otsu.best_threshold(all_var, invert)[1]
+            if 'reduced' in self.methods:
+                reduced_moments = reduced_counts * numpy.arange(256)
+                all_var = superpixels_otsu.otsu_variance(self.superpixels(), reduced_moments.sum(), reduced_counts, reduced_moments, invert)
+                thresholds['reduced'] = superpixels_otsu.best_threshold(all_var, invert)[1]
+        return thresholds
+
+    def superpixels(self):
+        return int(self.dot_counts.sum())
+
+    def accepted_superpixels(self, threshold):
+        dots = numpy.arange(-1, 257)
+        return int(self.dot_counts[dots < threshold if self.indexer.invert else dots > threshold].sum())
+
+    def write_masks(self, thresholds, paths):
+        # thresholds[method] and paths[method] of the masks, 0/255 uint8 .npy files of the image's size
+        invert = self.indexer.invert
+        outputs = dict((method, create_raster(paths[method], self.shape, numpy.uint8)) for method in thresholds)
+        for rows, cols in tiles(self.shape, self.tile_size):
+            if 'regular' in thresholds:
+                image_ubyte = self.temporary['ubyte'].read(rows, cols)
+                mask = pipeline.otsu_pixels(image_ubyte, invert, thresholds['regular'])[1]
+                with profiling.stage('save'):
+                    outputs['regular'].write(rows, cols, mask)
+            superpixel_methods = [method for method in ('sp', 'reduced') if method in thresholds]
+            if superpixel_methods:
+                dot = self.temporary['dot'].read(rows, cols)
+            for method in superpixel_methods:
+                with profiling.stage('mask'):
+                    accepted = dot < thresholds[method] if invert else dot > thresholds[method]
+                    mask = accepted.astype(numpy.uint8) * numpy.uint8(255)
+                with profiling.stage('save'):
+                    outputs[method].write(rows, cols, mask)
+
+    def close(self):
+        for raster in self.temporary.values():
+            os.remove(raster.filename)
+        self.temporary = {}
+
+def add_arguments(ap):
+    ap.add_argument("--tile-size", required = False, help = "Side of the square tiles the image is processed in, in pixels. Memory use grows with its square, not with the image.", default = 1024, type = int)
+    ap.add_argument("--tempdir", required = False, help = "Directory of the temporary memory-mapped files kept between the passes (1 byte per pixel for the regular method, 2 for the superpixel methods). The system's temporary directory by default.")
+
+def check_arguments(ap, args):
+    if args['fused']:
+        ap.error('The fused index quantizes every image over its own range, it cannot be used tile by tile (use the default float index or --lut).')
+    if args.get('superpixels') not in (None, 'slic', 'grid'):
+        ap.error('Tiles need a superpixel backend segmenting every tile on its own (slic or grid).')
+    if args['tile_size'] < 16:
+        ap.error('--tile-size should be at least 16 pixels.')
@@ -0,0 +1,94 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+import superpixels_backend
+import pipeline
+import profiling
+import results_io
+import mosaic
+
+import os
+
+import argparse
+import argparse_help
+
+argparse.ArgumentParser.set_default_subparser = argparse_help.set_default_subparser
+
+def main():
+
+    profiling.main_started()
+
+    # construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(add_help=False, description = "Run Otsu's thresholding on pixels, on superpixels and on reduced superpixels of images too large for memory (stitched orthomosaics), tile by tile. The thresholds are global, merged from the histograms of the tiles; the masks are written as memory-mapped .npy files.")
+
+    ap.add_argument ('-h', '--help', action=argparse_help._HelpAction, help='show this help message and exit')
+
+    ap.add_argument("-s", "--save", required = False, help = "Save the masks as <image>_<method suffix>_<index>.npy (0/255 uint8, readable with numpy.load(mmap_mode='r'))", action = "store_true")
+    ap.add_argument("-i", "--image", required = True, nargs = '+', help = "Path to the image or images to be processed: .npy arrays or uncompressed TIFFs, read memory-mapped.")
+    ap.add_argument("-o", "--output-dir", required = False, help = "Directory of the saved masks. Next to the images by default.")
+    ap.add_argument("--method", required = False, help = "Method to run (can be repeated). All methods are run by default.", action = "append", choices = pipeline.METHODS)
+
+    ap.add_argument("-a", "--alpha", required = False, help = "Recency factor alpha, from range [0.0, 1.0], for the regular and reduced methods. Lower values mean longer system memory", default = "1.0", type=argparse_help.ratioFloat)
+
+    pipeline.add_index_arguments(ap)
+    superpixels_backend.add_arguments(ap)
+    mosaic.add_arguments(ap)
+    results_io.add_arguments(ap)
+    profiling.add_arguments(ap)
+
+    ap.add_argument("-v", "--verbose", required = False, help = "Increase output verbosity", action = "store_true")
+
+    pipeline.add_model_arguments(ap)
+
+    args = vars(ap.parse_args())
+    mosaic.check_arguments(ap, args)
+
+    pipeline.check_index_arguments(ap, args)
+    pipeline.check_model_arguments(ap, args)
+
+    methods = [method for method in pipeline.METHODS if not args['method'] or method in args['method']]
+    indexer = pipeline.FrameIndexer.from_args(args)
+    backend = superpixels_backend.from_args(args)
+    dot_function = pipeline.dot_function_from_args(args, args['verbose'])
+    recency = dict((method, pipeline.Recency(args['alpha'])) for method in pipeline.RECENCY_METHODS)
+
+    print("# {}".format(" ".join(methods)))
+    if 'sp' in methods or 'reduced' in methods:
+        print("# Superpixel backend: {}, {} pixel tiles".format(backend.describe(), args['tile_size']))
+
+    writers = results_io.from_args(args)
+    times = profiling.from_args(args)
+
+    for image_path in args['image']:
+        frame = mosaic.MosaicFrame(image_path, indexer, methods, backend, dot_function, args['tile_size'], args['save'], args['tempdir'])
+        try:
+            raw = frame.analyze(args['verbose'])
+            thresholds = dict((method, recency[method](thr) if method in recency else thr) for method, thr in raw.items())
+            if args['save']:
+                name = os.path.splitext(image_path)[0]
+                if args['output_dir']:
+                    name = os.path.join(args['output_dir'], os.path.basename(name))
+                frame.write_masks(thresholds, dict((method, name+pipeline.MASK_SUFFIX[method]+args['color_index']+'.npy') for method in methods))
+        finally:
+            frame.close()
+
+        if args['verbose']:
+            print("Input image {} ({}x{}): {}".format(image_path, frame.shape[1], frame.shape[0], ", ".join("{} T={}".format(method, thresholds[method]) for method in methods)))
+        else:
+            print(" ".join("{}".format(thresholds[method]) for method in methods))
+
+        frame_times = times.take()
+        for writer in writers:
+            for method in methods:
+                accepted, superpixels = None, None
+                if method != 'regular':
+                    accepted, superpixels = frame.accepted_superpixels(thresholds[method]), frame.superpixels()
+                writer.write(results_io.record(args, image_path, method, raw[method], thresholds[method], accepted, superpixels, frame_times))
+
+    for writer in writers:
+        writer.close()
+    backend.close()
+    profiling.finish(times)
+
+if __name__ == "__main__":
+    main()
@@ -3,25 +3,18 @@
 
 import superpixels_dot
 import superpixels_otsu
-import color_index
-
-import matplotlib.pyplot as plt
-
-from skimage.color import rgb2gray
-from skimage.segmentation import slic
-from skimage.segmentation import mark_boundaries
-from skimage.util import img_as_float
-from skimage.util import img_as_ubyte
-from skimage import io
-from skimage import exposure
+import superpixels_backend
+import frame_cache
+import pipeline
+import profiling
+import results_io
+import mask_writer
+import plotting
 
 import os
 
-from functools import partial
-
 import argparse
 import argparse_help
-import numpy
 
 import sys
 
@@ -29,6 +22,8 @@ argparse.ArgumentParser.set_default_subparser = argparse_help.set_default_subpar
 
 def main():
 
+    profiling.main_started()
+
     # construct the argument parser and parse the arguments
     ap = argparse.ArgumentParser(add_help=False, description = "Run Otsu's thresholding on a superpixel image or sequence of images (treating superpixels as single pixels) using a selected color index.")
 
@@ -40,92 +35,100 @@ def main():
     
     ap.add_argument("-a", "--alpha", required = False, help = "Recency factor alpha, from range [0.0, 1.0]. Lower values mean longer system memory", default = "1.0", type=argparse_help.ratioFloat)
 
-    ap.add_argument("-c", "--color-index", required = False, help = "Specify color index to use for obtaining the grayscale image to threshold", default = "CIVE", choices = ["CIVE", "nCIVE", "ExG", "ExR", "mExG", "nExG", "nExR", "nmExG", "VEG"])
+    pipeline.add_index_arguments(ap)
+    superpixels_backend.add_arguments(ap)
+    frame_cache.add_arguments(ap)
 
     #verbosity_group = ap.add_mutually_exclusive_group()    
+    pipeline.add_jobs_arguments(ap)
+    results_io.add_arguments(ap)
+    mask_writer.add_arguments(ap)
+    profiling.add_arguments(ap)
+    plotting.add_arguments(ap)
+
     ap.add_argument("-v", "--verbose", required = False, help = "Increase output verbosity", action = "store_true")
     #verbosity_group.add_argument("-q", "--quiet", required = False, help = "Quiet execution. Only one number per line for each image is output.", action = "store_true")
 
-    ap.add_argument("-m", "--model", required = False, help = "Select a model used for superpixel representation.", action = "store_true")
-    subparsers = ap.add_subparsers(help="Model selection for the --model option. (Only used when -m is used)", dest='model_sel')   
-    # average parser
-    avg_parser = subparsers.add_parser('avg', help = "Use the average superpixel graylevel as superpixel model (Superpixel sp accepted for theshold T if avg(sp) > T).")
-    # median parser
-    med_parser = subparsers.add_parser('med', help = "Use the median superpixel graylevel as superpixel model (Superpixel sp accepted for theshold T if med(sp) > T).")
-    # percentage parser
-    perc_parser = subparsers.add_parser('perc', help = "Use the acceptance percentage as superpixel model (Superpixel sp is accepted for threshold T if the ratio of pixels p > T and total pixels in the region is greater than k).")
-    perc_parser.add_argument("-k", help = "Defines the acceptance percentage for the percentage model. Values from [0.0, 1.0] accepted.", required = False, default = "0.7", type=argparse_help.ratioFloat)
-
-    ap.set_default_subparser('no_model')
+    pipeline.add_model_arguments(ap)
 
     args = vars(ap.parse_args())
-
-    if args['model'] and args['model_sel'] == 'no_model':
-        parser.error('A model needs to be provided {avg, med, perc} when --model is used.')
-    if args['model_sel'] != 'no_model' and not args['model']:
-        parser.error('A model is only accepted when --model option is provided.')
-
-    thr_first = True
-    thr_cur = 0
+    mask_writer.check_arguments(ap, args)
+    plotting.from_args(args)
+
+    pipeline.check_index_arguments(ap, args)
+    pipeline.check_model_arguments(ap, args)
+    pipeline.check_jobs_arguments(ap, args)
+
+    indexer = pipeline.FrameIndexer.from_args(args)
+    invert = indexer.invert
+    recency = pipeline.Recency(args['alpha'])
+
+    backend = superpixels_backend.from_args(args)
+    cache = frame_cache.from_args(args, args['verbose']) if backend.cacheable else None
+
+    writers = results_io.from_args(args)
+    masks = mask_writer.from_args(args)
+    times = profiling.from_args(args)
+
+    if args['jobs'] > 1:
+        for image_path, thr, thr_cur, frame_times, dot, output in pipeline.run_jobs(args, 'reduced', args['jobs'], masks):
+            times.merge(frame_times)
+            frame_times = times.take()
+            for writer in writers:
+                writer.write(results_io.record(args, image_path, 'reduced', thr, thr_cur, superpixels_otsu.accepted_superpixels(dot, thr_cur, invert), len(dot), frame_times))
+            sys.stdout.write(output)
+            if args['verbose']:
+                print("Otsu's segmentation completed, with T={}".format(int(thr)))
+                if thr_cur != thr:
+                    if args['alpha'] < 1.0:
+                        print("Recency corrected with alpha={} to T={}".format(args['alpha'], int(thr_cur)))
+                    superpixels_otsu.print_accepted(dot, thr_cur, invert)
+                print("Otsu's segmentation on superpixels completed, with T={}".format(thr_cur))
+                if image_path != args["image"][-1]:
+                    print
+            else:
+                print("{}".format(thr_cur))
+        for writer in writers:
+            writer.close()
+        if masks is not None:
+            masks.close()
+        backend.close()
+        profiling.finish(times)
+        return
+
+    indexer.loader.schedule(args["image"])
+
+    # mask buffer reused between frames (the mask writer saves a copy)
+    mask_out = None
 
     for image_path in args["image"]:
 
-        # load the image and convert it to a floating point data type
-        img = img_as_float(io.imread(image_path))
-
         if args['verbose']:
             print("Input image {}.".format(image_path))
 
-        normalize = False
-        invert = False
-        if args['color_index'][0] == 'n':
-            normalize = True
-        if args['color_index'][-4:] == 'CIVE':
-            img_index = numpy.apply_along_axis(partial(color_index.CIVE, normalize = normalize), 2, img)
-            invert = True
-        elif args['color_index'][-3:] == 'ExG':
-            img_index = numpy.apply_along_axis(partial(color_index.excess_green, normalize = normalize), 2, img)
-        elif args['color_index'][-3:] == 'ExR':
-            img_index = numpy.apply_along_axis(partial(color_index.excess_red, normalize = normalize), 2, img)
-        elif args['color_index'][-4:] == 'mExR':
-            img_index = numpy.apply_along_axis(partial(color_index.modified_excess_green, normalize = normalize), 2, img)
-        elif args['color_index'][-3:] == 'VEG':
-            img_index = numpy.apply_along_axis(partial(color_index.VEG, normalize = normalize), 2, img)
-
-        #print("Min max {} {}".format(img_index.min(), img_index.max()))
-
-        image_gray_norm = exposure.rescale_intensity(img_index, in_range = (img_index.min(), img_index.max())) # get range -1 to 1 
+        img, image_gray_norm, image_ubyte, segments_slic = pipeline.frame_data(image_path, indexer, backend, cache, need_image = bool(args['display']))
 
         if args['verbose']:
             print("Image {} calculated.".format(args['color_index']))
             if args['save']:
-                plt.imsave(os.path.splitext(image_path)[0]+"_"+args['color_index']+os.path.splitext(image_path)[-1], image_gray_norm, cmap = 'gray')
+                with profiling.stage('save'):
+                    plotting.imsave(os.path.splitext(image_path)[0]+"_"+args['color_index']+os.path.splitext(image_path)[-1], image_gray_norm, cmap = 'gray')
 
-        segments_slic = slic(image_gray_norm, n_segments=35000, sigma = 0, convert2lab=False, compactness=0.05)
+        if args['verbose'] and image_path == args["image"][0]: # recorded as a comment line, skipped when the results are loaded
+            print("# Superpixel backend: {}".format(backend.describe()))
 
         if args['verbose']:
-            print("SLIC superpixels calculated. ")
+            print("Superpixels calculated.")
 
-        if not args['model'] or args['model_sel'] == 'avg':
-            dot_function = superpixels_dot.average_dot
-            if args['verbose']:
-                print("Using the average ('avg') model for superpixel acceptance.")
-        elif args['model_sel'] == 'med':
-            dot_function = superpixels_dot.median_dot
-            if args['verbose']:
-                print("Using the median ('med') model for superpixel acceptance.")
-        elif args['model_sel'] == 'perc':
-            dot_function = partial(superpixels_dot.k_percent_dot, k = args['k'])
-            if args['verbose']:
-                print("Using the acceptance percentage ('perc') model for superpixel acceptance.")
+        stats = superpixels_dot.SuperpixelStats(image_ubyte, segments_slic)
 
-        thr, ret = superpixels_otsu.otsu_superpixels_reduced_fixed_dot(img_as_ubyte(image_gray_norm), segments_slic, invert = invert, dot_function = dot_function, verbose = args['verbose'])[:2]
+        dot_function = pipeline.dot_function_from_args(args, args['verbose'])
 
-        if not thr_first:
-            thr_cur = int(thr_cur * (1-args['alpha']) + thr * args['alpha'])
-        else:
-            thr_cur = thr
-            thr_first = False
+        thr, ret = superpixels_otsu.otsu_superpixels_reduced_fixed_dot(image_ubyte, segments_slic, invert = invert, dot_function = dot_function, verbose = args['verbose'], stats = stats, out = mask_out)[:2]
+        mask_out = ret
+
+        thr_raw = thr
+        thr_cur = recency(thr)
 
         if args['verbose']:
             print("Otsu's segmentation completed, with T={}".format(int(thr)))
@@ -134,7 +137,7 @@ def main():
             if args['verbose'] and args['alpha'] < 1.0:
                 print("Recency corrected with alpha={} to T={}".format(args['alpha'], int(thr_cur)))
 
-            thr, ret =superpixels_otsu.otsu_only_mask(img_as_ubyte(image_gray_norm), segments_slic, thr_cur, invert = invert, dot_function = dot_function, verbose = args['verbose'])
+            thr, ret =superpixels_otsu.otsu_only_mask(image_ubyte, segments_slic, thr_cur, invert = invert, dot_function = dot_function, verbose = args['verbose'], stats = stats, out = mask_out)
 
         
         if args['verbose']:
@@ -143,9 +146,15 @@ def main():
             print("{}".format(thr))
 
         if args['save']:
-            plt.imsave(os.path.splitext(image_path)[0]+"_sprseg_"+args['color_index']+os.path.splitext(image_path)[-1], ret, cmap = 'gray')
+            with profiling.stage('save'):
+                masks.save(os.path.splitext(image_path)[0]+"_sprseg_"+args['color_index']+os.path.splitext(image_path)[-1], ret)
+
+        frame_times = times.take()
+        for writer in writers:
+            writer.write(results_io.record(args, image_path, 'reduced', thr_raw, thr, superpixels_otsu.accepted_superpixels(stats.dot(dot_function, invert), thr, invert), len(stats), frame_times))
 
         if args["display"]:
+            plt = plotting.pyplot()
             if args["display"] == "single":
                 fig, ax = plt.subplots(1,1, figsize=(5,5), sharex=True, sharey=True, subplot_kw={'adjustable':'box-forced'})
                 ax.imshow(ret, cmap = 'gray')
@@ -163,10 +172,16 @@ def main():
                     a.set_axis_off()
 
             plt.tight_layout()
-            plt.show()
+            plotting.show(image_path, args['color_index'])
         if args['verbose'] and image_path != args["image"][-1]:
             print
 
+    for writer in writers:
+        writer.close()
+    if masks is not None:
+        masks.close()
+    backend.close()
+    profiling.finish(times)
 
 if __name__ == "__main__":
     main()
@@ -3,24 +3,15 @@
 
 import superpixels_dot
 import superpixels_otsu
-import color_index
-
-import matplotlib.pyplot as plt
-
-from skimage.color import rgb2gray
-from skimage.segmentation import slic
-from skimage.segmentation import mark_boundaries
-from skimage.util import img_as_float
-from skimage.util import img_as_ubyte
-from skimage import io
-from skimage import exposure
+import pipeline
+import profiling
+import results_io
+import mask_writer
+import plotting
 
 import os
 
-from functools import partial
-
 import argparse
-import numpy
 
 import sys
 
@@ -28,6 +19,8 @@ import argparse_help
 
 def main():
 
+    profiling.main_started()
+
     # construct the argument parser and parse the arguments
     ap = argparse.ArgumentParser(description = "Run Otsu's thresholding on an image or sequence of images using a selected color index.")
 
@@ -39,57 +32,71 @@ def main():
 
     ap.add_argument("-a", "--alpha", required = False, help = "Recency factor alpha, from range [0.0, 1.0]. Lower values mean longer system memory", default = "1.0", type=argparse_help.ratioFloat)
 
-    ap.add_argument("-c", "--color-index", required = False, help = "Specify color index to use for obtaining the grayscale image to threshold", default = "CIVE", choices = ["CIVE", "nCIVE", "ExG", "ExR", "mExG", "nExG", "nExR", "nmExG", "VEG"])
+    pipeline.add_index_arguments(ap)
+
+    pipeline.add_jobs_arguments(ap)
+    results_io.add_arguments(ap)
+    mask_writer.add_arguments(ap)
+    profiling.add_arguments(ap)
+    plotting.add_arguments(ap)
 
     ap.add_argument("-v", "--verbose", required = False, help = "Increase output verbosity", action = "store_true")
     
     args = vars(ap.parse_args())
+    mask_writer.check_arguments(ap, args)
+    plotting.from_args(args)
+
+    pipeline.check_index_arguments(ap, args)
+    pipeline.check_jobs_arguments(ap, args)
+
+    indexer = pipeline.FrameIndexer.from_args(args)
+    invert = indexer.invert
+    recency = pipeline.Recency(args['alpha'])
+
+    writers = results_io.from_args(args)
+    masks = mask_writer.from_args(args)
+    times = profiling.from_args(args)
+
+    if args['jobs'] > 1:
+        for image_path, thr, thr_cur, frame_times, dot, output in pipeline.run_jobs(args, 'regular', args['jobs'], masks):
+            times.merge(frame_times)
+            frame_times = times.take()
+            for writer in writers:
+                writer.write(results_io.record(args, image_path, 'regular', int(thr), int(thr_cur), times = frame_times))
+            sys.stdout.write(output)
+            if args['verbose']:
+                print("Otsu's segmentation completed, with T={}".format(int(thr)))
+                if thr_cur != thr and args['alpha'] < 1.0:
+                    print("Recency corrected with alpha={} to T={}".format(args['alpha'], int(thr_cur)))
+                if image_path != args["image"][-1]:
+                    print
+            else:
+                print("{}".format(int(thr_cur)))
+        for writer in writers:
+            writer.close()
+        if masks is not None:
+            masks.close()
+        profiling.finish(times)
+        return
 
-    thr_cur = 0
-    thr_first = True
+    indexer.loader.schedule(args["image"])
 
     for image_path in args["image"]:
-        # load the image and convert it to a floating point data type
-        img = img_as_float(io.imread(image_path))
+        img, image_gray_norm, image_ubyte = indexer(image_path)
 
         if args['verbose']:
             print("Input image {}.".format(image_path))
 
-        normalize = False
-        invert = False
-        if args['color_index'][0] == 'n':
-            normalize = True
-        if args['color_index'][-4:] == 'CIVE':
-            img_index = numpy.apply_along_axis(partial(color_index.CIVE, normalize = normalize), 2, img)
-            invert = True
-        elif args['color_index'][-3:] == 'ExG':
-            img_index = numpy.apply_along_axis(partial(color_index.excess_green, normalize = normalize), 2, img)
-        elif args['color_index'][-3:] == 'ExR':
-            img_index = numpy.apply_along_axis(partial(color_index.excess_red, normalize = normalize), 2, img)
-        elif args['color_index'][-4:] == 'mExR':
-            img_index = numpy.apply_along_axis(partial(color_index.modified_excess_green, normalize = normalize), 2, img)
-        elif args['color_index'][-3:] == 'VEG':
-            img_index = numpy.apply_along_axis(partial(color_index.VEG, normalize = normalize), 2, img)
-
-        image_gray_norm = exposure.rescale_intensity(img_index, in_range = (img_index.min(), img_index.max())) # get range -1 to 1 
-
         if args['verbose']:
             print("Image {} calculated.".format(args['color_index']))
             if args['save']:
-                plt.imsave(os.path.splitext(image_path)[0]+"_"+args['color_index']+os.path.splitext(image_path)[-1], image_gray_norm, cmap = 'gray')
-
-        import cv2
+                with profiling.stage('save'):
+                    plotting.imsave(os.path.splitext(image_path)[0]+"_"+args['color_index']+os.path.splitext(image_path)[-1], image_gray_norm, cmap = 'gray')
 
-        if invert:
-            thr, ret =cv2.threshold(img_as_ubyte(image_gray_norm),0,255,cv2.THRESH_OTSU+cv2.THRESH_BINARY_INV)
-        else:
-            thr, ret =cv2.threshold(img_as_ubyte(image_gray_norm),0,255,cv2.THRESH_OTSU+cv2.THRESH_BINARY)
+        thr, ret = pipeline.otsu_pixels(image_ubyte, invert)
+        thr_raw = thr
 
-        if not thr_first:
-            thr_cur = int(thr_cur * (1-args['alpha']) + thr * args['alpha'])
-        else:
-            thr_cur = thr
-            thr_first = False
+        thr_cur = recency(thr)
 
         if args['verbose']:
             print("Otsu's segmentation completed, with T={}".format(int(thr)))
@@ -98,19 +105,22 @@ def main():
             if args['verbose'] and args['alpha'] < 1.0:
                 print("Recency corrected with alpha={} to T={}".format(args['alpha'], int(thr_cur)))
 
-            if invert:
-                thr, ret =cv2.threshold(img_as_ubyte(image_gray_norm),thr_cur,255,cv2.THRESH_BINARY_INV)
-            else:
-                thr, ret =cv2.threshold(img_as_ubyte(image_gray_norm),thr_cur,255,cv2.THRESH_BINARY)
+            thr, ret = pipeline.otsu_pixels(image_ubyte, invert, thr_cur)
 
 
         if not args['verbose']:
             print("{}".format(int(thr)))
         
         if args['save']:
-            plt.imsave(os.path.splitext(image_path)[0]+"_seg_"+args['color_index']+os.path.splitext(image_path)[-1], ret, cmap = 'gray')
+            with profiling.stage('save'):
+                masks.save(os.path.splitext(image_path)[0]+"_seg_"+args['color_index']+os.path.splitext(image_path)[-1], ret)
+
+        frame_times = times.take()
+        for writer in writers:
+            writer.write(results_io.record(args, image_path, 'regular', int(thr_raw), int(thr), times = frame_times))
 
         if args["display"]:
+            plt = plotting.pyplot()
             if args["display"] == "single":
                 fig, ax = plt.subplots(1,1, figsize=(5,5), sharex=True, sharey=True, subplot_kw={'adjustable':'box-forced'})
                 ax.imshow(ret, cmap = 'gray')
@@ -128,9 +138,15 @@ def main():
                     a.set_axis_off()
 
             plt.tight_layout()
-            plt.show()
+            plotting.show(image_path, args['color_index'])
         if args['verbose'] and image_path != args["image"][-1]:
             print
 
+    for writer in writers:
+        writer.close()
+    if masks is not None:
+        masks.close()
+    profiling.finish(times)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+import superpixels_backend
+import frame_cache
+import frame_watch
+import pipeline
+import profiling
+import results_io
+import mask_writer
+
+import os
+import sys
+import time
+
+import argparse
+import argparse_help
+
+argparse.ArgumentParser.set_default_subparser = argparse_help.set_default_subparser
+
+def main():
+
+    profiling.main_started()
+
+    # construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(add_help=False, description = "Run Otsu's thresholding on pixels, on superpixels and on reduced superpixels in a single pass over an image or sequence of images, sharing the loading, color index and superpixels between the methods.")
+
+    ap.add_argument ('-h', '--help', action=argparse_help._HelpAction, help='show this help message and exit')
+
+    ap.add_argument("-s", "--save", required = False, help = "Save the output images to file", action = "store_true")
+    source_group = ap.add_mutually_exclusive_group(required = True)
+    source_group.add_argument("-i", "--image", nargs = '+', help = "Path to the image or images to be processed.")
+    source_group.add_argument("-w", "--watch", help = "Watch a capture directory and process the frames as they arrive, carrying the recency state across them. Each result line is followed by a comment with the frame and its latency from arrival; stops on Ctrl-C.")
+    ap.add_argument("-o", "--output", required = False, help = "Write the thresholds of each method to OUTPUT_<method>.txt, in the format of the method's script. Without it, one line per image with the thresholds of all methods is output.")
+    ap.add_argument("--method", required = False, help = "Method to run (can be repeated). All methods are run by default.", action = "append", choices = pipeline.METHODS)
+
+    ap.add_argument("-a", "--alpha", required = False, help = "Recency factor alpha, from range [0.0, 1.0], for the regular and reduced methods. Lower values mean longer system memory", default = "1.0", type=argparse_help.ratioFloat)
+
+    pipeline.add_index_arguments(ap)
+    superpixels_backend.add_arguments(ap)
+    frame_cache.add_arguments(ap)
+    frame_watch.add_arguments(ap)
+    results_io.add_arguments(ap)
+    mask_writer.add_arguments(ap)
+    profiling.add_arguments(ap)
+
+    ap.add_argument("-v", "--verbose", required = False, help = "Increase output verbosity", action = "store_true")
+
+    pipeline.add_model_arguments(ap)
+
+    args = vars(ap.parse_args())
+    mask_writer.check_arguments(ap, args)
+
+    pipeline.check_index_arguments(ap, args)
+    pipeline.check_model_arguments(ap, args)
+
+    methods = [method for method in pipeline.METHODS if not args['method'] or method in args['method']]
+    indexer = pipeline.FrameIndexer.from_args(args)
+    backend = superpixels_backend.from_args(args)
+    cache = frame_cache.from_args(args, args['verbose']) if backend.cacheable else None
+    dot_function = pipeline.dot_function_from_args(args, args['verbose'])
+
+    if args['output']:
+        streams = dict((method, open("{}_{}.txt".format(args['output'], method), 'w')) for method in methods)
+    for method in methods:
+        if method != 'regular' and args['output']:
+            streams[method].write("# Superpixel backend: {}\n".format(backend.describe()))
+    if not args['output']:
+        print("# {}".format(" ".join(methods)))
+        if 'sp' in methods or 'reduced' in methods:
+            print("# Superpixel backend: {}".format(backend.describe()))
+
+    if args['watch']:
+        watcher = frame_watch.from_args(args).start()
+        latency = frame_watch.Latency()
+        arrivals = {}
+        dropped = 0
+        def arrived():
+            for image_path, arrival in watcher:
+                arrivals[image_path] = arrival
+                yield image_path
+        image_paths = arrived()
+    else:
+        image_paths = args['image']
+        indexer.loader.schedule(image_paths)
+
+    writers = results_io.from_args(args)
+    masks = mask_writer.from_args(args)
+    times = profiling.from_args(args)
+
+    frames = pipeline.run_frames(image_paths, indexer, methods, backend, dot_function, args['alpha'], cache, args['verbose'])
+    try:
+        for image_path, results in frames:
+            if args['watch']:
+                frame_latency = time.time() - arrivals.pop(image_path)
+                latency.add(frame_latency)
+                # latency as a trailing comment, skipped when the results are loaded
+                comment = "  # {} {:.1f} ms".format(os.path.basename(image_path), 1000 * frame_latency)
+                if watcher.dropped != dropped:
+                    print("# dropped {} frames".format(watcher.dropped - dropped))
+                    dropped = watcher.dropped
+            else:
+                comment = ""
+            report(args, methods, streams if args['output'] else None, masks, image_path, results, comment)
+            # stage times of the frame, shared by the methods
+            frame_times = times.take()
+            for writer in writers:
+                for method in methods:
+                    thr, mask, thr_raw, accepted, superpixels = results[method]
+                    writer.write(results_io.record(args, image_path, method, thr_raw, thr, accepted, superpixels, frame_times))
+            if args['watch']:
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        if not args['watch']:
+            raise
+    finally:
+        if args['watch']:
+            watcher.stop()
+
+    if args['watch']:
+        print("# {} frames, {} dropped, latency mean {:.1f} ms, max {:.1f} ms".format(latency.count, watcher.dropped, 1000 * latency.mean(), 1000 * latency.max))
+
+    if args['output']:
+        for stream in streams.values():
+            stream.close()
+    for writer in writers:
+        writer.close()
+    if masks is not None:
+        masks.close()
+    backend.close()
+    profiling.finish(times)
+
+def report(args, methods, streams, masks, image_path, results, comment = ""):
+    if args['verbose']:
+        print("Input image {}: {}{}".format(image_path, ", ".join("{} T={}".format(method, results[method][0]) for method in methods), comment))
+
+    if args['output']:
+        for method in methods:
+            streams[method].write("{}\n".format(results[method][0]))
+            streams[method].flush()
+        if comment and not args['verbose']:
+            print(comment.strip())
+    elif not args['verbose']:
+        print(" ".join("{}".format(results[method][0]) for method in methods) + comment)
+
+    if args['save']:
+        for method in methods:
+            with profiling.stage('save'):
+                masks.save(os.path.splitext(image_path)[0]+pipeline.MASK_SUFFIX[method]+args['color_index']+os.path.splitext(image_path)[-1], results[method][1])
+
+if __name__ == "__main__":
+    main()
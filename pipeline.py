@@ -0,0 +1,364 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# shared per-frame pipeline of the Otsu scripts: image loading, color index image and its quantization,
+# superpixels (optionally through the frame cache) and the three thresholding methods
+#   regular: Otsu's thresholding on pixels (otsu_regular.py)
+#   sp:      Otsu's thresholding on superpixels (otsu_sp.py)
+#   reduced: Otsu's thresholding treating superpixels as pixels (otsu_reduced_sp.py)
+# run_frames computes the shared intermediates once per frame and yields the results of all the methods
+
+import superpixels_dot
+import superpixels_otsu
+import superpixels_backend
+import frame_cache
+import color_index
+import color_index_lut
+import color_index_fused
+import image_loader
+import profiling
+import mask_writer
+import plotting
+
+from cStringIO import StringIO
+from functools import partial
+
+import argparse_help
+import multiprocessing
+import numpy
+import os
+import sys
+
+METHODS = ['regular', 'sp', 'reduced']
+
+# the recency filter is applied by the regular and reduced methods (as in their scripts)
+RECENCY_METHODS = ['regular', 'reduced']
+
+# suffixes of the saved masks, as in the script of each method
+MASK_SUFFIX = {'regular': '_seg_', 'sp': '_spseg_', 'reduced': '_sprseg_'}
+
+def add_index_arguments(ap):
+    ap.add_argument("-c", "--color-index", required = False, help = "Specify color index to use for obtaining the grayscale image to threshold", default = "CIVE", choices = color_index.index_choices())
+    ap.add_argument("-l", "--lut", required = False, help = "Compute the index image through a cached 8-bit rgb lookup table, quantized over a fixed range instead of each image's own range", action = "store_true")
+    ap.add_argument("--lut-range", required = False, help = "Fixed index range (min max) quantized by the lookup table. Defaults to the full range of the index over all 8-bit rgb values; required for VEG and the normalized indices, for which that range is degenerate.", nargs = 2, type = float)
+    ap.add_argument("-f", "--fused", required = False, help = "Compute the quantized index image in a single float32 stage with buffers reused between images (may differ by one graylevel on rounding boundaries)", action = "store_true")
+    image_loader.add_arguments(ap)
+
+def check_index_arguments(ap, args):
+    if args['lut'] and args['lut_range'] is None and color_index_lut.needs_range(*color_index.parse_index_name(args['color_index'])):
+        ap.error('--lut needs --lut-range with the {} index.'.format(args['color_index']))
+
+def add_model_arguments(ap):
+    ap.add_argument("-m", "--model", required = False, help = "Select a model used for superpixel representation.", action = "store_true")
+    subparsers = ap.add_subparsers(help="Model selection for the --model option. (Only used when -m is used)", dest='model_sel')
+    # average parser
+    avg_parser = subparsers.add_parser('avg', help = "Use the average superpixel graylevel as superpixel model (Superpixel sp accepted for theshold T if avg(sp) > T).")
+    # median parser
+    med_parser = subparsers.add_parser('med', help = "Use the median superpixel graylevel as superpixel model (Superpixel sp accepted for theshold T if med(sp) > T).")
+    # percentage parser
+    perc_parser = subparsers.add_parser('perc', help = "Use the acceptance percentage as superpixel model (Superpixel sp is accepted for threshold T if the ratio of pixels p > T and total pixels in the region is greater than k).")
+    perc_parser.add_argument("-k", help = "Defines the acceptance percentage for the percentage model. Values from [0.0, 1.0] accepted.", required = False, default = "0.7", type=argparse_help.ratioFloat)
+
+    ap.set_default_subparser('no_model')
+
+def check_model_arguments(ap, args):
+    if args['model'] and args['model_sel'] == 'no_model':
+        ap.error('A model needs to be provided {avg, med, perc} when --model is used.')
+    if args['model_sel'] != 'no_model' and not args['model']:
+        ap.error('A model is only accepted when --model option is provided.')
+
+def dot_function_from_args(args, verbose = False):
+    if not args['model'] or args['model_sel'] == 'avg':
+        if verbose:
+            print("Using the average ('avg') model for superpixel acceptance.")
+        return superpixels_dot.average_dot_array
+    elif args['model_sel'] == 'med':
+        if verbose:
+            print("Using the median ('med') model for superpixel acceptance.")
+        return superpixels_dot.median_dot_array
+    elif args['model_sel'] == 'perc':
+        if verbose:
+            print("Using the acceptance percentage ('perc') model for superpixel acceptance.")
+        return partial(superpixels_dot.k_percent_dot_array, k = args['k'])
+
+class FrameIndexer(object):
+    # image path -> (image, index image for display and segmentation, quantized uint8 index image). With the
+    # lookup table, the index image is only computed (from a second, levels table) when superpixels is set
+
+    def __init__(self, index_name = 'CIVE', lut = False, lut_range = None, fused = False, verbose = False, loader = None, superpixels = False):
+        self.name = index_name
+        self.loader = loader or image_loader.ImageLoader()
+        self.index, self.normalize = color_index.parse_index_name(index_name)
+        self.invert = color_index.INDICES[self.index].invert
+        self.lut = None
+        self.levels = None
+        self.fused = None
+        self.lut_range = lut_range
+        if lut:
+            self.lut = color_index_lut.load_lut(self.index, self.normalize, lut_range, verbose = verbose)
+            if superpixels:
+                self.levels = color_index_lut.load_lut(self.index, self.normalize, lut_range, verbose = verbose, levels = True)
+                self.level_values = color_index_lut.level_values(self.index, self.normalize, lut_range)
+        elif fused:
+            self.fused = color_index_fused.FusedIndex(self.index, self.normalize)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args['color_index'], args['lut'], args['lut_range'], args['fused'], args['verbose'], image_loader.from_args(args), args.get('superpixels') is not None)
+
+    def cache_params(self):
+        # everything the quantized index image depends on besides the image
+        if self.lut is not None:
+            return (self.name, 'lut-levels', self.lut_range)
+        return (self.name, 'fused-float' if self.fused is not None else 'float', None)
+
+    @profiling.timed('decode')
+    def load(self, image_path):
+        return self.prepare(self.loader(image_path))
+
+    def prepare(self, img):
+        # the 8-bit image as index_image takes it: converted to a floating point data type, except for the LUT and fused index
+        if self.lut is not None or self.fused is not None:
+            return img
+        from skimage.util import img_as_float
+
+        return img_as_float(img)
+
+    @profiling.timed('index')
+    def index_range(self, img):
+        # (min, max) of the float index image, to quantize the tiles of a large image to their common range
+        img_index = color_index.index_array(img, self.index, self.normalize)
+        return img_index.min(), img_index.max()
+
+    @profiling.timed('index')
+    def index_image(self, img, in_range = None):
+        # the float index image is quantized over in_range, by default its own range
+        if self.lut is not None:
+            image_ubyte = color_index_lut.apply_lut(self.lut, img)
+            if self.levels is None:
+                return image_ubyte, image_ubyte
+            return numpy.take(self.level_values, color_index_lut.apply_lut(self.levels, img)), image_ubyte
+        if self.fused is not None:
+            return self.fused.index_images(img, in_range)
+        from skimage.util import img_as_ubyte
+        from skimage import exposure
+
+        img_index = color_index.index_array(img, self.index, self.normalize)
+        if in_range is None:
+            in_range = (img_index.min(), img_index.max())
+        with profiling.stage('rescale'):
+            image_gray_norm = exposure.rescale_intensity(img_index, in_range = in_range) # get range -1 to 1
+            return image_gray_norm, img_as_ubyte(image_gray_norm)
+
+    def __call__(self, image_path):
+        img = self.load(image_path)
+        return (img,) + self.index_image(img)
+
+def frame_data(image_path, indexer, backend = None, cache = None, need_image = True):
+    # (image, index image, quantized index image, superpixel labels) of a frame. Labels are only computed
+    # with a backend; with a cache, a hit skips loading (unless need_image), indexing and segmenting,
+    # in which case the index image is the quantized one
+    if backend is None:
+        cache = None
+    if cache is not None:
+        frame_key = cache.frame_key(image_path, *(indexer.cache_params() + (backend.describe(),)))
+        cached = cache.load_frame(frame_key)
+        if cached is not None:
+            image_ubyte, labels = cached
+            if not need_image:
+                indexer.loader.discard(image_path)
+            return (indexer.load(image_path) if need_image else None), image_ubyte, image_ubyte, labels
+
+    img, image_gray_norm, image_ubyte = indexer(image_path)
+    labels = None
+    if backend is not None:
+        with profiling.stage('superpixels'):
+            labels = backend.segment(image_gray_norm)
+    if cache is not None:
+        cache.store_frame(frame_key, image_ubyte, labels)
+    return img, image_gray_norm, image_ubyte, labels
+
+class Recency(object):
+    # thr_cur = thr_cur * (1 - alpha) + thr * alpha, starting from the first threshold
+
+    def __init__(self, alpha = 1.0):
+        self.alpha = alpha
+        self.thr_cur = None
+
+    def __call__(self, thr):
+        if self.thr_cur is None:
+            self.thr_cur = thr
+        else:
+            self.thr_cur = int(self.thr_cur * (1 - self.alpha) + thr * self.alpha)
+        return self.thr_cur
+
+def otsu_pixels(image_ubyte, invert = False, threshold = None):
+    # Otsu's threshold and mask on pixels, or the mask at a given threshold
+    import cv2
+
+    flags = cv2.THRESH_BINARY_INV if invert else cv2.THRESH_BINARY
+    if threshold is None:
+        with profiling.stage('otsu'):
+            return cv2.threshold(image_ubyte, 0, 255, cv2.THRESH_OTSU + flags)
+    with profiling.stage('mask'):
+        return cv2.threshold(image_ubyte, threshold, 255, flags)
+
+def run_frames(image_paths, indexer, methods = METHODS, backend = None, dot_function = superpixels_dot.average_dot_array, alpha = 1.0, cache = None, verbose = False):
+    # generator of (image_path, results) in frame order, results[method] = (threshold, mask, raw threshold,
+    # accepted superpixels, superpixels) with the threshold as printed by the method's script (after the
+    # recency correction for the regular and reduced methods, the raw threshold is the one before it) and
+    # the superpixel counts None for the regular method. The image, index image, labels and
+    # superpixel statistics are computed once per frame. The superpixel masks are buffers reused for the next
+    # frame, so they have to be saved or copied before it
+    recency = dict((method, Recency(alpha)) for method in RECENCY_METHODS)
+    mask_out = {}
+    superpixels = 'sp' in methods or 'reduced' in methods
+    for image_path in image_paths:
+        img, image_gray_norm, image_ubyte, labels = frame_data(image_path, indexer, backend if superpixels else None, cache, need_image = False)
+        results = {}
+
+        if 'regular' in methods:
+            thr, ret = otsu_pixels(image_ubyte, indexer.invert)
+            thr_raw = int(thr)
+            thr_cur = recency['regular'](thr)
+            if thr_cur != thr:
+                thr, ret = otsu_pixels(image_ubyte, indexer.invert, thr_cur)
+            results['regular'] = (int(thr), ret, thr_raw, None, None)
+
+        if superpixels:
+            stats = superpixels_dot.SuperpixelStats(image_ubyte, labels)
+
+        if 'sp' in methods:
+            thr, ret = superpixels_otsu.otsu_superpixels_fixed_dot(image_ubyte, labels, invert = indexer.invert, dot_function = dot_function, verbose = verbose, stats = stats, out = mask_out.get('sp'))[:2]
+            mask_out['sp'] = ret
+            results['sp'] = (thr, ret, thr, superpixels_otsu.accepted_superpixels(stats.dot(dot_function, indexer.invert), thr, indexer.invert), len(stats))
+
+        if 'reduced' in methods:
+            thr, ret = superpixels_otsu.otsu_superpixels_reduced_fixed_dot(image_ubyte, labels, invert = indexer.invert, dot_function = dot_function, verbose = verbose, stats = stats, out = mask_out.get('reduced'))[:2]
+            mask_out['reduced'] = ret
+            thr_raw = thr
+            thr_cur = recency['reduced'](thr)
+            if thr_cur != thr:
+                thr, ret = superpixels_otsu.otsu_only_mask(image_ubyte, labels, thr_cur, invert = indexer.invert, dot_function = dot_function, verbose = verbose, stats = stats, out = ret)
+            results['reduced'] = (thr, ret, thr_raw, superpixels_otsu.accepted_superpixels(stats.dot(dot_function, indexer.invert), thr, indexer.invert), len(stats))
+
+        yield image_path, results
+
+# --jobs mode of otsu_regular.py and otsu_reduced_sp.py. The raw per-frame thresholds are independent, so
+# they are computed in a process pool (phase 1); the recency filter, the only dependency between frames, is
+# applied in frame order in the main process as the thresholds arrive (phase 2); and the masks at the
+# corrected thresholds are built and saved in the pool (phase 3). What the serial script prints for a frame
+# up to its raw threshold is printed in the worker to a buffer and written out by the main process in frame
+# order, together with the rest of the frame's lines
+
+JOB = {}
+
+def init_job(args, method):
+    # every worker reads its own frames, without prefetching
+    JOB['verbose'] = args['verbose']
+    args = dict(args, verbose = False, prefetch = 0)
+    JOB['args'] = args
+    JOB['method'] = method
+    JOB['indexer'] = FrameIndexer.from_args(args)
+    JOB['times'] = profiling.activate(profiling.StageTimes())
+    if method == 'reduced':
+        JOB['backend'] = superpixels_backend.from_args(args)
+        JOB['cache'] = frame_cache.from_args(args, JOB['verbose'])
+
+def save_index_image(image_path, image_gray_norm):
+    # the index image saved by the serial scripts with --verbose and --save
+    with profiling.stage('save'):
+        plotting.imsave(os.path.splitext(image_path)[0]+"_"+JOB['args']['color_index']+os.path.splitext(image_path)[-1], image_gray_norm, cmap = 'gray')
+
+def job_threshold(image_path):
+    # phase 1: raw threshold of a frame, what phase 3 needs to build its mask at another threshold (the
+    # quantized index image, or the DOT lookup and labels of the superpixels), the stage times (and DOTs,
+    # for counting the accepted superpixels) of the frame's results record and the frame's printed output
+    args, indexer, verbose = JOB['args'], JOB['indexer'], JOB['verbose']
+    JOB['times'].take()
+    output, sys.stdout = sys.stdout, StringIO()
+    try:
+        if JOB['method'] == 'regular':
+            image_gray_norm, image_ubyte = indexer(image_path)[1:]
+            if verbose:
+                print("Input image {}.".format(image_path))
+                print("Image {} calculated.".format(args['color_index']))
+                if args['save']:
+                    save_index_image(image_path, image_gray_norm)
+            thr = otsu_pixels(image_ubyte, indexer.invert)[0]
+            return thr, image_ubyte if args['save'] else None, JOB['times'].take(), None, sys.stdout.getvalue()
+
+        if verbose:
+            print("Input image {}.".format(image_path))
+        image_gray_norm, image_ubyte, labels = frame_data(image_path, indexer, JOB['backend'], JOB['cache'], need_image = False)[1:]
+        if verbose:
+            print("Image {} calculated.".format(args['color_index']))
+            if args['save']:
+                save_index_image(image_path, image_gray_norm)
+        if verbose and image_path == args['image'][0]:
+            print("# Superpixel backend: {}".format(JOB['backend'].describe()))
+        if verbose:
+            print("Superpixels calculated.")
+        stats = superpixels_dot.SuperpixelStats(image_ubyte, labels)
+        dot = stats.dot(dot_function_from_args(args, verbose), indexer.invert)
+        thr = superpixels_otsu.otsu_reduced_core(stats, dot, indexer.invert, verbose)[1]
+        if verbose:
+            superpixels_otsu.print_accepted(dot, thr, indexer.invert)
+        data = None
+        if args['save']:
+            # DOT of every label id, and the labels in the smallest type that holds them
+            labels = numpy.asarray(labels)
+            data = stats.label_lookup(dot), labels.astype(numpy.uint16 if labels.max() < (1 << 16) else numpy.uint32)
+        return thr, data, JOB['times'].take(), dot if args['results'] or verbose else None, sys.stdout.getvalue()
+    finally:
+        sys.stdout = output
+
+def job_mask(job):
+    # phase 3: mask at the corrected threshold, saved as by the serial script. Masks of the sequence formats
+    # are encoded here and returned, to be appended to the sequence file in frame order
+    image_path, thr, data = job
+    args, indexer = JOB['args'], JOB['indexer']
+    if JOB['method'] == 'regular':
+        mask = otsu_pixels(data, indexer.invert, thr)[1]
+    else:
+        dot, labels = data
+        accepted = dot < thr if indexer.invert else dot > thr
+        mask = numpy.take(accepted.astype(numpy.uint8) * numpy.uint8(255), labels)
+    path = os.path.splitext(image_path)[0]+MASK_SUFFIX[JOB['method']]+args['color_index']+os.path.splitext(image_path)[-1]
+    if args['mask_format'] in mask_writer.SEQUENCE_FORMATS:
+        return path, mask.shape, mask_writer.encode(mask, args['mask_format'])
+    mask_writer.write_image(path, mask, args['mask_format'])
+
+def run_jobs(args, method, jobs, masks = None):
+    # generator of (image_path, raw threshold, corrected threshold, stage times, DOTs or None, printed
+    # output) in frame order. The times of the masks and saving in phase 3 are not included; masks is the mask_writer.MaskWriter
+    # appending the encoded masks to a sequence file
+    pool = multiprocessing.Pool(jobs, init_job, (args, method))
+    try:
+        recency = Recency(args['alpha'])
+        saved = []
+        for image_path, (thr, data, times, dot, output) in zip(args['image'], pool.imap(job_threshold, args['image'])):
+            thr_cur = recency(thr)
+            if args['save']:
+                saved.append(pool.apply_async(job_mask, ((image_path, thr_cur, data),)))
+            while saved and saved[0].ready():
+                append_mask(masks, saved.pop(0).get())
+            yield image_path, thr, thr_cur, times, dot, output
+        for result in saved:
+            append_mask(masks, result.get())
+    finally:
+        pool.close()
+        pool.join()
+
+def append_mask(masks, encoded):
+    if encoded is not None:
+        masks.save_encoded(*encoded)
+
+def add_jobs_arguments(ap):
+    ap.add_argument("-j", "--jobs", required = False, help = "Number of processes computing the per-frame thresholds (and saving the masks) in parallel. The recency correction is applied in frame order, so the output is the same as with a single process. Not available with --display.", default = 1, type = int)
+
+def check_jobs_arguments(ap, args):
+    if args['jobs'] > 1 and args['display']:
+        ap.error('--jobs cannot be used with --display.')
+    if args['jobs'] > 1 and args.get('superpixels') not in (None, 'slic', 'grid'):
+        ap.error('--jobs needs a superpixel backend segmenting every frame on its own (slic or grid).')
@@ -0,0 +1,48 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# matplotlib for the Otsu scripts, imported on first use: runs that neither display nor save never load it,
+# and saving the images only needs matplotlib's image writer (no pyplot, no GUI toolkit). In headless mode
+# the non-interactive Agg backend is selected before pyplot is imported, and the figures of --display are
+# written next to the image as <name>_fig_<index>.png instead of shown
+
+import os
+
+HEADLESS = [False]
+
+def use_headless():
+    import matplotlib
+
+    matplotlib.use('Agg')
+    HEADLESS[0] = True
+
+def pyplot():
+    import matplotlib.pyplot as plt
+
+    return plt
+
+def imsave(path, image, cmap = 'gray'):
+    # same file as pyplot.imsave
+    from matplotlib.image import imsave as write_image
+
+    write_image(path, image, cmap = cmap)
+
+def mark_boundaries(image, superpixels):
+    from skimage.segmentation import mark_boundaries as draw_boundaries
+
+    return draw_boundaries(image, superpixels)
+
+def show(image_path, color_index):
+    plt = pyplot()
+    if not HEADLESS[0]:
+        plt.show()
+        return
+    plt.savefig(os.path.splitext(image_path)[0]+"_fig_"+color_index+".png")
+    plt.close('all')
+
+def add_arguments(ap):
+    ap.add_argument("--headless", required = False, help = "Never load a GUI toolkit: use matplotlib's non-interactive backend and save the figures of --display next to the images as <name>_fig_<index>.png", action = "store_true")
+
+def from_args(args):
+    if args.get('headless'):
+        use_headless()
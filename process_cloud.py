@@ -2,22 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import common # for to_Point_rgb
-import mayavi
 import os
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from pandas.tools.plotting import scatter_matrix
 import numpy
-from mayavi import mlab
-from mayavi import tools
 from scipy.ndimage.filters import gaussian_filter
 from itertools import chain
 import collections
 
-import matplotlib
+# matplotlib, pandas' plotting and mayavi (with its GUI toolkit) are imported by the display functions that
+# use them, so that loading the module for the cloud processing alone stays fast and works without a display
 
-values_rgb = numpy.mgrid[0:256, 0:256, 0:256]
-lut_rgb = numpy.vstack((values_rgb[0].reshape(1, 256**3), values_rgb[1].reshape(1, 256**3), values_rgb[2].reshape(1, 256**3), 255*numpy.ones((1, 256**3)))).T.astype('int32')
+lut_rgb = None
+
+def color_lut():
+    # rgba lookup table of all the 256**3 colors (256 MB of int32), built on first use
+    global lut_rgb
+    if lut_rgb is None:
+        values_rgb = numpy.mgrid[0:256, 0:256, 0:256]
+        lut_rgb = numpy.vstack((values_rgb[0].reshape(1, 256**3), values_rgb[1].reshape(1, 256**3), values_rgb[2].reshape(1, 256**3), 255*numpy.ones((1, 256**3)))).T.astype('int32')
+    return lut_rgb
 
 def add_index(cloud, index, name = 'index'):
     cloud[name] = map(index, map(common.to_Point_rgb, zip(cloud.r, cloud.g, cloud.b)))
@@ -59,6 +61,8 @@ def filter_cloud(cloud, low, high, cmin = None, cmax = None, both = False):
 def display_stats(cloud, indices = None, low = 0.0008, high = 0.9992, output_file = None, dpi = 100, show = True, cmin = None, cmax = None, both = False):
     if not output_file and not show:
         return
+    import matplotlib.pyplot as plt
+    from pandas.tools.plotting import scatter_matrix
 
     plt.close('all')
     plt.ioff()
@@ -97,6 +101,7 @@ def stats_pair(cloud, indices, \
                levels = (0.03, 0.08, 0.15, 0.4, 0.6, 0.8), nbins = 50):
     if not output_file and not show:
         return
+    import matplotlib.pyplot as plt
 
     plt.close('all')
     fig, ax = plt.subplots()
@@ -164,6 +169,7 @@ def stats_pair(cloud, indices, \
 def display_index_cloud(cloud, index, low = 0.005, high = 0.995, output_file = None, show = True, invert = False, mmin = None, mmax = None, density = 5):
     if not output_file and not show:
         return
+    from mayavi import mlab
     cloud = cloud[numpy.abs(cloud.z - cloud.z.mean()) <= 3*cloud.z.std()]
     cloud.reset_index(drop = True, inplace = True)
 
@@ -230,6 +236,7 @@ def display_index_cloud(cloud, index, low = 0.005, high = 0.995, output_file = N
 def display_color_cloud(cloud, output_file = None, show = True, density = 5):
     if not output_file and not show:
         return
+    from mayavi import mlab
     cloud = cloud[numpy.abs(cloud.z - cloud.z.mean()) <= 3*cloud.z.std()]
     cloud.reset_index(drop = True, inplace = True)
 
@@ -241,6 +248,7 @@ def display_color_cloud(cloud, output_file = None, show = True, density = 5):
     points = mlab.points3d(cloud['x'], cloud['y'], cloud['z'], scalars, figure = fig, mode='sphere', scale_mode = 'none', scale_factor = 0.02, mask_points = density)
 
     points.glyph.color_mode = 'color_by_scalar'
+    lut_rgb = color_lut()
     points.module_manager.scalar_lut_manager.lut._vtk_obj.SetTableRange(0, lut_rgb.shape[0])
     points.module_manager.scalar_lut_manager.lut.number_of_colors = lut_rgb.shape[0]
     points.module_manager.scalar_lut_manager.lut.table = lut_rgb
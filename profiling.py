@@ -0,0 +1,258 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# per-stage wall times of the frame pipeline. The stages are code sections wrapped in
+#   with profiling.stage('dot'):
+# (or functions decorated with @profiling.timed('dot')), which add their time to the active recorders, if
+# any. Times are exclusive: a stage entered inside another one is not counted in the outer stage, so the
+# stage times add up to the frame's time. StageTimes keeps the times of the current frame, taken by the
+# scripts once the frame is done.
+# With --profile, a Profiler records the stage times of every frame, the RSS after each stage and the memory
+# allocated within it (tracemalloc's peak where available, else the growth of the RSS), and prints a summary
+# table with percentiles at the end of the run (to stderr, so that the results on stdout are unchanged);
+# --profile-dump also saves a cProfile of the run for pstats or snakeviz. The startup time (from the process
+# start to the first frame, split at the script's main() into imports and setup) is reported with it.
+# Totals, means and maxima are kept over all the frames and the percentiles over a uniform sample of at most
+# SAMPLE_FRAMES of them, so that the memory of the profiler stays flat on endless (--watch) runs
+
+import collections
+import contextlib
+import functools
+import numpy
+import os
+import random
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+from timeit import default_timer as timer
+
+SAMPLE_FRAMES = 10000
+
+STAGES = ['decode', 'index', 'rescale', 'superpixels', 'histogram', 'dot', 'otsu', 'mask', 'save']
+
+RECORDERS = []
+
+# [stage name, time spent in nested stages] of the stages being timed
+OPEN_STAGES = []
+
+# wall clock times of the import of this module and of the start of the script's main()
+STARTUP = {'imported': time.time()}
+
+class StageTimes(object):
+
+    def __init__(self):
+        self.frame = self.empty()
+
+    def empty(self):
+        return collections.OrderedDict((name, 0.0) for name in STAGES)
+
+    def enter(self, name):
+        pass
+
+    def add(self, name, seconds):
+        self.frame[name] += seconds
+
+    def merge(self, times):
+        # stage times measured elsewhere (by the --jobs workers)
+        for name, seconds in times.items():
+            self.add(name, seconds)
+
+    def take(self):
+        # times of the frame so far, starting a new frame
+        times, self.frame = self.frame, self.empty()
+        return times
+
+def current_rss():
+    # resident set size in bytes, from /proc on Linux, else the peak so far
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, AttributeError):
+        return peak_rss()
+
+def peak_rss():
+    if resource is None:
+        return 0
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def process_start():
+    # wall clock time at which the process started, from its age in /proc on Linux (to the clock tick), else
+    # the import of this module
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError, AttributeError):
+        return STARTUP['imported']
+
+def main_started():
+    # called first in the scripts' main(): the time before it goes to the interpreter and the imports
+    STARTUP['main'] = time.time()
+
+def startup_times():
+    # seconds from the process start to main() (None if not marked) and to now
+    start = process_start()
+    main = STARTUP.get('main')
+    return (main - start if main is not None else None), time.time() - start
+
+class Profiler(StageTimes):
+
+    def __init__(self, dump_path = None):
+        StageTimes.__init__(self)
+        self.startup = startup_times()
+        self.count = 0
+        self.totals = numpy.zeros(len(STAGES) + 1)
+        self.maxima = numpy.zeros(len(STAGES) + 1)
+        self.sample = []
+        self.random = random.Random(0)
+        self.rss = dict((name, 0) for name in STAGES)
+        self.allocated = dict((name, 0) for name in STAGES)
+        self.start_memory = []
+        self.traced = tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+        if self.traced and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.dump_path = dump_path
+        self.profile = None
+        if dump_path:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def memory(self):
+        return tracemalloc.get_traced_memory()[0] if self.traced else current_rss()
+
+    def enter(self, name):
+        # [memory at the start, peak traced memory of the stage before its last nested stage]. The peak is
+        # reset for every stage, so the peak so far is first folded into the enclosing stage
+        if self.traced:
+            if self.start_memory:
+                self.start_memory[-1][1] = max(self.start_memory[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.start_memory.append([self.memory(), 0])
+
+    def add(self, name, seconds):
+        StageTimes.add(self, name, seconds)
+        start, peak = self.start_memory.pop()
+        if self.traced:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if self.start_memory:
+                self.start_memory[-1][1] = max(self.start_memory[-1][1], peak)
+            allocated = peak - start
+        else:
+            allocated = current_rss() - start
+        self.allocated[name] = max(self.allocated[name], allocated)
+        self.rss[name] = max(self.rss[name], current_rss())
+
+    def merge(self, times):
+        for name, seconds in times.items():
+            StageTimes.add(self, name, seconds)
+
+    def take(self):
+        times = StageTimes.take(self)
+        row = list(times.values())
+        row.append(sum(row))
+        self.count += 1
+        self.totals += row
+        self.maxima = numpy.maximum(self.maxima, row)
+        # reservoir sampling: every frame so far is in the sample with the same probability
+        if len(self.sample) < SAMPLE_FRAMES:
+            self.sample.append(row)
+        else:
+            replaced = self.random.randrange(self.count)
+            if replaced < SAMPLE_FRAMES:
+                self.sample[replaced] = row
+        return times
+
+    def report(self, stream = sys.stderr):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.dump_path)
+        imports, startup = self.startup
+        if imports is not None:
+            stream.write("# Startup {:.1f} ms to the first frame: interpreter and imports {:.1f} ms, arguments and setup {:.1f} ms\n".format(1000 * startup, 1000 * imports, 1000 * (startup - imports)))
+        else:
+            stream.write("# Startup {:.1f} ms to the first frame\n".format(1000 * startup))
+        if not self.count:
+            return
+        sample = 1000 * numpy.array(self.sample)
+        totals, maxima = 1000 * self.totals, 1000 * self.maxima
+        percentiles = "percentiles over {} sampled frames, ".format(len(self.sample)) if len(self.sample) < self.count else ""
+        stream.write("# Profile of {} frames (times in ms, memory in MB; {}{})\n".format(self.count, percentiles, "largest allocation traced by tracemalloc" if self.traced else "largest RSS growth within the stage"))
+        stream.write("# {:<12} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10}\n".format('stage', 'total', 'mean', 'p50', 'p90', 'p99', 'max', 'rss', 'allocated'))
+        for column, name in enumerate(STAGES + ['frame']):
+            if name != 'frame' and not maxima[column]:
+                continue
+            p50, p90, p99 = numpy.percentile(sample[:, column], [50, 90, 99])
+            if name == 'frame':
+                rss, allocated = peak_rss(), max(self.allocated.values())
+            else:
+                rss, allocated = self.rss[name], self.allocated[name]
+            # no memory figures for the stages only timed by the --jobs workers
+            memory = ["{:.1f}".format(value / 1048576.0) if rss else '-' for value in (rss, allocated)]
+            stream.write("# {:<12} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9} {:>10}\n".format(name, totals[column], totals[column] / self.count, p50, p90, p99, maxima[column], memory[0], memory[1]))
+        if self.dump_path:
+            stream.write("# cProfile saved to {}\n".format(self.dump_path))
+
+def activate(recorder):
+    RECORDERS.append(recorder)
+    return recorder
+
+def deactivate(recorder):
+    RECORDERS.remove(recorder)
+
+@contextlib.contextmanager
+def stage(name):
+    if not RECORDERS:
+        yield
+        return
+    for recorder in RECORDERS:
+        recorder.enter(name)
+    start = timer()
+    OPEN_STAGES.append([name, 0.0])
+    try:
+        yield
+    finally:
+        seconds = timer() - start
+        nested = OPEN_STAGES.pop()[1]
+        if OPEN_STAGES:
+            OPEN_STAGES[-1][1] += seconds
+        for recorder in RECORDERS:
+            recorder.add(name, seconds - nested)
+
+def timed(name):
+    # decorator timing every call of a function as the given stage
+    def decorate(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorate
+
+def add_arguments(ap):
+    ap.add_argument("--profile", required = False, help = "Print the time of each stage (with percentiles over the frames), the RSS after it and the largest allocation within it at the end of the run, to stderr", action = "store_true")
+    ap.add_argument("--profile-dump", required = False, help = "Also save a cProfile of the run to this file (for pstats or snakeviz). Implies --profile")
+
+def from_args(args):
+    # active recorder of the stage times, a Profiler with --profile
+    if args.get('profile') or args.get('profile_dump'):
+        return activate(Profiler(args.get('profile_dump')))
+    return activate(StageTimes())
+
+def finish(recorder):
+    deactivate(recorder)
+    if isinstance(recorder, Profiler):
+        recorder.report()
@@ -0,0 +1,120 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# structured results of the Otsu scripts: one record per frame and method with the parameters, the raw and
+# recency corrected thresholds, the number of accepted superpixels and the wall time of each stage, written
+# as CSV (.csv), JSON Lines (.jsonl) or a binary columnar numpy file (.npz, written when the run ends).
+# Missing values (the superpixel counts of the regular method) are empty in CSV, null in JSON and NaN in npz
+
+import profiling
+
+import collections
+import csv
+import json
+import numpy
+import os
+
+FIELDS = ['frame', 'method', 'color_index', 'model', 'k', 'alpha', 'threshold', 'threshold_corrected', 'accepted', 'superpixels'] + ['time_' + name for name in profiling.STAGES]
+
+TEXT_FIELDS = ['frame', 'method', 'color_index', 'model']
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.npz': 'npz'}
+
+def results_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError("Unknown results format '{}' (use {}).".format(extension, ", ".join(sorted(FORMATS))))
+    return FORMATS[extension]
+
+def record(args, image_path, method, threshold, threshold_corrected, accepted = None, superpixels = None, times = None):
+    # model and k as given on the command line ('avg' without a model); alpha only applies to the regular and reduced methods
+    model = args['model_sel'] if args.get('model') else 'avg'
+    result = collections.OrderedDict([
+        ('frame', image_path),
+        ('method', method),
+        ('color_index', args['color_index']),
+        ('model', model),
+        ('k', args.get('k') if model == 'perc' else None),
+        ('alpha', args.get('alpha', 1.0) if method != 'sp' else None),
+        ('threshold', threshold),
+        ('threshold_corrected', threshold_corrected),
+        ('accepted', accepted),
+        ('superpixels', superpixels)])
+    for name in profiling.STAGES:
+        result['time_' + name] = round(times[name], 6) if times is not None else None
+    return result
+
+class ResultsWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.format = results_format(path)
+        if self.format == 'npz':
+            self.columns = collections.OrderedDict((field, []) for field in FIELDS)
+        else:
+            self.stream = open(path, 'w')
+            if self.format == 'csv':
+                self.writer = csv.writer(self.stream)
+                self.writer.writerow(FIELDS)
+
+    def write(self, result):
+        values = [result.get(field) for field in FIELDS]
+        if self.format == 'npz':
+            for field, value in zip(FIELDS, values):
+                self.columns[field].append(value)
+            return
+        if self.format == 'csv':
+            self.writer.writerow(['' if value is None else value for value in values])
+        else:
+            self.stream.write(json.dumps(collections.OrderedDict(zip(FIELDS, values))) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        if self.format == 'npz':
+            columns = dict((field, numpy.array(values, dtype = str) if field in TEXT_FIELDS else numpy.array([numpy.nan if value is None else value for value in values], dtype = numpy.float64)) for field, values in self.columns.items())
+            with open(self.path, 'wb') as f:
+                numpy.savez(f, **columns)
+        else:
+            self.stream.close()
+
+def read_results(path):
+    # OrderedDict of columns, text columns as string arrays and the others as float64 (NaN for missing values)
+    results_type = results_format(path)
+    if results_type == 'npz':
+        data = numpy.load(path)
+        return collections.OrderedDict((field, data[field]) for field in FIELDS if field in data.files)
+
+    columns = collections.OrderedDict((field, []) for field in FIELDS)
+    with open(path) as f:
+        if results_type == 'csv':
+            rows = [dict((field, value if value != '' else None) for field, value in row.items()) for row in csv.DictReader(f)]
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for row in rows:
+        for field in FIELDS:
+            columns[field].append(row.get(field))
+    for field in FIELDS:
+        if field in TEXT_FIELDS:
+            columns[field] = numpy.array(columns[field], dtype = str)
+        else:
+            columns[field] = numpy.array([numpy.nan if value is None else float(value) for value in columns[field]], dtype = numpy.float64)
+    return columns
+
+def load_thresholds(path, method = None, column = 'threshold_corrected'):
+    # (thresholds, methods) of an image sequence: one row per frame and column per method (squeezed for a
+    # single method). Text result files of the scripts are read with numpy.loadtxt as before, without methods
+    if os.path.splitext(path)[1].lower() not in FORMATS:
+        return numpy.loadtxt(path, unpack = 'False'), None
+    columns = read_results(path)
+    methods = [method] if method else list(collections.OrderedDict.fromkeys(columns['method']))
+    series = [columns[column][columns['method'] == name] for name in methods]
+    if len(series) == 1:
+        return series[0], methods
+    length = min(len(values) for values in series)
+    return numpy.column_stack([values[:length] for values in series]), methods
+
+def add_arguments(ap):
+    ap.add_argument("-r", "--results", required = False, help = "Also write one record per image and method, with the parameters, thresholds, accepted superpixels and stage times, to this file: .csv, .jsonl or .npz (binary columnar, written at the end). Can be repeated.", action = "append")
+
+def from_args(args):
+    return [ResultsWriter(path) for path in args['results'] or []]
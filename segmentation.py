@@ -13,8 +13,6 @@ from skimage.util import img_as_float
 from skimage.util import img_as_ubyte
 from skimage import io
 
-from timeit import default_timer as timer
-
 import argparse
 
 
@@ -100,7 +98,6 @@ def otsu_superpixel(image, superpixels, k = 0.7, invert = False):
 
     
     print("Accepted {} out of {} superpixels".format(len(accepted), len(histograms)))
-    start = timer()
 
     mask = numpy.zeros(image.shape[:2], dtype = "uint8")
     mask[numpy.in1d(superpixels, accepted).reshape(mask.shape)] = 255
@@ -121,11 +118,10 @@ print("Image input")
 #img = img_as_float(astronaut()[::2, ::2])
 
 import color_index
-from functools import partial
 
 from skimage import exposure
 
-img_CIVE = numpy.apply_along_axis(partial(color_index.CIVE, normalize = False), 2, img)
+img_CIVE = color_index.CIVE_array(img, normalize = False)
 img_CIVE_norm = exposure.rescale_intensity(img_CIVE, in_range = (img_CIVE.min(), img_CIVE.max()))
 
 print(img_CIVE_norm.min())
@@ -0,0 +1,403 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# superpixel backends producing the label map of a (grayscale index) image. Every backend has
+# segment(image), returning labels numbered from 0, and describe(), used to record the backend
+# and its parameters in the output and as part of the frame cache key (when cacheable)
+#   slic:  skimage SLIC on the whole image (the original setup)
+#   tiled: SLIC on overlapping tiles in a process pool, superpixels merged across the seams into one id space
+#   grid:  fixed square lattice of about n_segments cells, computed once per image size
+#   sequence: lattice SLIC for image sequences, seeded with the previous frame's centers
+
+import argparse_help
+import collections
+import math
+import multiprocessing
+import numpy
+
+class SlicBackend(object):
+
+    cacheable = True
+
+    def __init__(self, n_segments = 35000, compactness = 0.05, sigma = 0):
+        self.n_segments = n_segments
+        self.compactness = compactness
+        self.sigma = sigma
+
+    def segment(self, image):
+        from skimage.segmentation import slic
+
+        return slic(image, n_segments = self.n_segments, sigma = self.sigma, convert2lab = False, compactness = self.compactness)
+
+    def describe(self):
+        return "slic(n_segments={}, compactness={}, sigma={})".format(self.n_segments, self.compactness, self.sigma)
+
+    def close(self):
+        pass
+
+def slic_tile(args):
+    # module level so that it can be sent to the pool workers
+    from skimage.segmentation import slic
+
+    tile, n_segments, compactness, sigma = args
+    return slic(tile, n_segments = n_segments, sigma = sigma, convert2lab = False, compactness = compactness)
+
+def compact_labels(labels):
+    # renumber the labels present to 0..n-1, keeping their order; returns the labels and n
+    sizes = numpy.bincount(labels.ravel())
+    lookup = numpy.cumsum(sizes > 0) - 1
+    return lookup[labels], lookup[-1] + 1
+
+def find_roots(parent):
+    # root of every id of a union-find forest whose roots are their smallest id
+    while True:
+        grandparent = parent[parent]
+        if numpy.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+def union(parent, a, b):
+    while parent[a] != a:
+        a = parent[a]
+    while parent[b] != b:
+        b = parent[b]
+    parent[max(a, b)] = min(a, b)
+
+def merge_across_seam(parent, a, b):
+    # a and b are the labels of the same band of pixels in two tiles' windows, in the common id space (-1 for the
+    # superpixels of the margins only). Superpixels that cover most of each other's pixels in the band are one
+    # superpixel cut by the seam
+    valid = (a >= 0) & (b >= 0)
+    if not valid.any():
+        return
+    count_a = numpy.bincount(a[a >= 0], minlength = len(parent))
+    count_b = numpy.bincount(b[b >= 0], minlength = len(parent))
+    pairs, counts = numpy.unique(a[valid].astype(numpy.int64) * len(parent) + b[valid], return_counts = True)
+    pa, pb = pairs // len(parent), pairs % len(parent)
+    mutual = (2 * counts > count_a[pa]) & (2 * counts > count_b[pb])
+    for i, j in zip(pa[mutual], pb[mutual]):
+        union(parent, i, j)
+
+class TiledSlicBackend(SlicBackend):
+    # the image is split into tiles x tiles cores; every core is segmented together with an overlap margin
+    # (so that superpixels at the core border see their surroundings) and the labels of the core are kept,
+    # offset past the labels of the previous tiles. n_segments is spread over the tiles by area.
+    # Neighbouring windows overlap in a band of 2 x overlap pixels around their seam; superpixels of the two
+    # tiles that mostly coincide in it are merged, so that superpixels crossing the seam are not cut in two.
+    # Without an overlap the cores are only put side by side and every seam is a superpixel border
+
+    def __init__(self, n_segments = 35000, compactness = 0.05, sigma = 0, tiles = (2, 2), overlap = 16, processes = None):
+        SlicBackend.__init__(self, n_segments, compactness, sigma)
+        self.tiles = tuple(tiles)
+        self.overlap = overlap
+        self.processes = processes
+        self.pool = None
+
+    def tile_bounds(self, shape):
+        rows = numpy.linspace(0, shape[0], self.tiles[0] + 1).astype(int)
+        cols = numpy.linspace(0, shape[1], self.tiles[1] + 1).astype(int)
+        for r0, r1 in zip(rows[:-1], rows[1:]):
+            for c0, c1 in zip(cols[:-1], cols[1:]):
+                # core and the margin-extended window around it
+                yield (r0, r1, c0, c1), (max(r0 - self.overlap, 0), min(r1 + self.overlap, shape[0]), max(c0 - self.overlap, 0), min(c1 + self.overlap, shape[1]))
+
+    def segment(self, image):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        area = float(image.shape[0] * image.shape[1])
+        bounds = list(self.tile_bounds(image.shape))
+        jobs = []
+        for core, (w0, w1, v0, v1) in bounds:
+            n_tile = max(1, int(round(self.n_segments * (w1 - w0) * (v1 - v0) / area)))
+            jobs.append((image[w0:w1, v0:v1], n_tile, self.compactness, self.sigma))
+        tile_labels = self.pool.map(slic_tile, jobs)
+
+        # window labels of every tile in the common id space: the superpixels of the core numbered past the
+        # previous tiles' ones, -1 for those of the margin only
+        labels = numpy.empty(image.shape[:2], dtype = numpy.int64)
+        windows = []
+        offset = 0
+        for ((r0, r1, c0, c1), (w0, w1, v0, v1)), tile in zip(bounds, tile_labels):
+            core = tile[r0 - w0:r1 - w0, c0 - v0:c1 - v0]
+            present = numpy.bincount(core.ravel(), minlength = tile.max() + 1) > 0
+            lookup = numpy.where(present, numpy.cumsum(present) - 1 + offset, -1)
+            labels[r0:r1, c0:c1] = lookup[core]
+            windows.append(lookup[tile])
+            offset += numpy.count_nonzero(present)
+
+        parent = numpy.arange(offset)
+        if self.overlap > 0:
+            for i, j in self.neighbours():
+                (w0, w1, v0, v1), (x0, x1, y0, y1) = bounds[i][1], bounds[j][1]
+                b0, b1, d0, d1 = max(w0, x0), min(w1, x1), max(v0, y0), min(v1, y1)
+                if b0 < b1 and d0 < d1:
+                    merge_across_seam(parent, windows[i][b0 - w0:b1 - w0, d0 - v0:d1 - v0], windows[j][b0 - x0:b1 - x0, d0 - y0:d1 - y0])
+        return compact_labels(find_roots(parent)[labels])[0]
+
+    def neighbours(self):
+        # (tile, tile) pairs sharing a seam, in the row-major order of tile_bounds
+        rows, cols = self.tiles
+        for row in xrange(rows):
+            for col in xrange(cols):
+                tile = row * cols + col
+                if col + 1 < cols:
+                    yield tile, tile + 1
+                if row + 1 < rows:
+                    yield tile, tile + cols
+
+    def describe(self):
+        return "tiled(n_segments={}, compactness={}, sigma={}, tiles={}x{}, overlap={}, seams=merged, processes={})".format(self.n_segments, self.compactness, self.sigma, self.tiles[0], self.tiles[1], self.overlap, self.processes or multiprocessing.cpu_count())
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+class GridBackend(object):
+    # square cells with the side giving about n_segments cells; the lattice only depends on the image size
+
+    cacheable = True
+
+    def __init__(self, n_segments = 35000):
+        self.n_segments = n_segments
+        self.shape = None
+
+    def segment(self, image):
+        if self.shape != image.shape[:2]:
+            self.shape = image.shape[:2]
+            self.step = max(1, int(round(math.sqrt(self.shape[0] * self.shape[1] / float(self.n_segments)))))
+            cols = -(-self.shape[1] // self.step)
+            self.labels = (numpy.arange(self.shape[0])[:, numpy.newaxis] // self.step) * cols + numpy.arange(self.shape[1])[numpy.newaxis, :] // self.step
+        return self.labels
+
+    def describe(self):
+        return "grid(n_segments={})".format(self.n_segments)
+
+    def close(self):
+        pass
+
+def block_mean(image, factor):
+    # image subsampled by averaging factor x factor blocks (smooths the noise that plain striding would alias)
+    h, w = image.shape[0] // factor * factor, image.shape[1] // factor * factor
+    return image[:h, :w].reshape(h // factor, factor, w // factor, factor).mean(axis = (1, 3))
+
+def phase_correlation(previous, current):
+    # global translation (dy, dx) such that current(y, x) ~ previous(y - dy, x - dx)
+    cross = numpy.fft.fft2(current) * numpy.conj(numpy.fft.fft2(previous))
+    cross /= numpy.maximum(numpy.abs(cross), 1e-12)
+    peak = numpy.unravel_index(numpy.argmax(numpy.fft.ifft2(cross).real), previous.shape)
+    return tuple(p - n if p > n // 2 else p for p, n in zip(peak, previous.shape))
+
+def overlap_correlation(previous, current, shift):
+    # correlation coefficient of the two images over their overlap after the shift
+    dy, dx = shift
+    h, w = current.shape
+    a = current[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)]
+    b = previous[max(-dy, 0):h + min(-dy, 0), max(-dx, 0):w + min(-dx, 0)]
+    if a.size < 2 or a.std() == 0 or b.std() == 0:
+        return 0.0
+    return numpy.corrcoef(a.ravel(), b.ravel())[0, 1]
+
+def enforce_connectivity(labels):
+    # every label keeps its largest 4-connected piece; the other pieces join the label of a neighbouring piece
+    # (through other such pieces if they only touch those)
+    from skimage.measure import label as connected_pieces
+
+    pieces = connected_pieces(labels, background = -1, connectivity = 1)
+    sizes = numpy.bincount(pieces.ravel())
+    owner = numpy.zeros(len(sizes), dtype = labels.dtype)
+    owner[pieces.ravel()] = labels.ravel()
+    ids = numpy.flatnonzero(sizes)
+    order = ids[numpy.lexsort((-sizes[ids], owner[ids]))]
+    first = numpy.ones(len(order), dtype = bool)
+    first[1:] = owner[order[1:]] != owner[order[:-1]]
+    resolved = numpy.zeros(len(sizes), dtype = bool)
+    resolved[order[first]] = True
+    if resolved[ids].all():
+        return labels
+
+    # pairs of 4-neighbouring pixels of different pieces, in both directions
+    a = numpy.concatenate((pieces[:, :-1].ravel(), pieces[:-1, :].ravel()))
+    b = numpy.concatenate((pieces[:, 1:].ravel(), pieces[1:, :].ravel()))
+    different = a != b
+    a, b = numpy.concatenate((a[different], b[different])), numpy.concatenate((b[different], a[different]))
+    while not resolved[ids].all():
+        join = ~resolved[a] & resolved[b]
+        owner[a[join]] = owner[b[join]]
+        resolved[a[join]] = True
+    return owner[pieces]
+
+class SequenceSlicBackend(object):
+    # SLIC on a lattice of centers: every pixel is compared with the centers anchored to its own and the 8
+    # neighbouring lattice cells (the 2S x 2S search window of SLIC), with the skimage distance
+    # ((v - v_c) / compactness)^2 + ((y - y_c)^2 + (x - x_c)^2) / S^2, in float32 with a running minimum over
+    # the candidates. Connectivity is enforced on the final labels, as by skimage's SLIC.
+    # For consecutive frames the previous final centers, shifted by the global motion (phase correlation on
+    # block means) when motion is set, seed the next frame, which then only runs warm_iterations.
+    # Frames whose overlap with the previous one correlates less than similarity start from the lattice.
+    # The labels depend on the previous frames, so they are not cached
+
+    cacheable = False
+
+    def __init__(self, n_segments = 35000, compactness = 0.05, iterations = 10, warm_iterations = 3, similarity = 0.8, motion = False, subsample = 4):
+        if iterations < 1 or warm_iterations < 1:
+            raise ValueError("At least one iteration is needed, got {} and {} warm.".format(iterations, warm_iterations))
+        self.n_segments = n_segments
+        self.compactness = compactness
+        self.iterations = iterations
+        self.warm_iterations = warm_iterations
+        self.similarity = similarity
+        self.motion = motion
+        self.subsample = subsample
+        self.shape = None
+        self.previous = None
+        self.warm_frames = 0
+        self.cold_frames = 0
+
+    def allocate(self, shape):
+        self.shape = shape
+        self.step = math.sqrt(shape[0] * shape[1] / float(self.n_segments))
+        self.grid = (max(1, int(round(shape[0] / self.step))), max(1, int(round(shape[1] / self.step))))
+        self.cell = (shape[0] / float(self.grid[0]), shape[1] / float(self.grid[1]))
+        self.y, self.x = numpy.mgrid[:shape[0], :shape[1]].astype(numpy.float32)
+        cell_y = numpy.minimum((self.y / self.cell[0]).astype(int), self.grid[0] - 1)
+        cell_x = numpy.minimum((self.x / self.cell[1]).astype(int), self.grid[1] - 1)
+        # the candidates of a pixel are the centers of its cell and of the 8 neighbouring ones, indexed in the
+        # lattice padded by a ring of centers at infinity (never the closest), so that the candidate of every
+        # pixel is its cell's index plus the same offset
+        gh, gw = self.grid
+        self.cells = ((cell_y + 1) * (gw + 2) + cell_x + 1).astype(numpy.int32)
+        self.offsets = [dy * (gw + 2) + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+        self.unpadded = numpy.zeros((gh + 2, gw + 2), dtype = numpy.int32)
+        self.unpadded[1:-1, 1:-1] = numpy.arange(gh * gw).reshape(self.grid)
+        self.unpadded = self.unpadded.ravel()
+        # running minimum over the candidates: candidate index and distance, closest distance and center
+        self.index = numpy.empty(shape, dtype = numpy.int32)
+        self.distance = numpy.empty(shape, dtype = numpy.float32)
+        self.term = numpy.empty(shape, dtype = numpy.float32)
+        self.best = numpy.empty(shape, dtype = numpy.float32)
+        self.closer = numpy.empty(shape, dtype = bool)
+        self.nearest = numpy.empty(shape, dtype = numpy.int32)
+        self.labels = numpy.empty(shape, dtype = numpy.int32)
+
+    def lattice_centers(self, image):
+        cy = (numpy.arange(self.grid[0]) + 0.5) * self.cell[0]
+        cx = (numpy.arange(self.grid[1]) + 0.5) * self.cell[1]
+        cy, cx = numpy.meshgrid(cy, cx, indexing = 'ij')
+        cv = image[numpy.minimum(cy.astype(int), self.shape[0] - 1), numpy.minimum(cx.astype(int), self.shape[1] - 1)]
+        return cy.ravel(), cx.ravel(), cv.ravel().astype(numpy.float64)
+
+    def shifted_centers(self, image, centers, present, shift):
+        # centers move with the image and their anchors by whole cells. Cells entering the frame, centers that
+        # were left without pixels and centers that drifted more than a cell from their anchor restart on the lattice
+        lattice = [c.reshape(self.grid) for c in self.lattice_centers(image)]
+        ky, kx = int(round(shift[0] / self.cell[0])), int(round(shift[1] / self.cell[1]))
+        gh, gw = self.grid
+        src = (slice(max(-ky, 0), gh + min(-ky, 0)), slice(max(-kx, 0), gw + min(-kx, 0)))
+        dst = (slice(max(ky, 0), gh + min(ky, 0)), slice(max(kx, 0), gw + min(kx, 0)))
+        shifted = [c.copy() for c in lattice]
+        for new, old, offset in zip(shifted, centers, (shift[0], shift[1], 0)):
+            new[dst] = old.reshape(self.grid)[src] + offset
+        keep = numpy.zeros(self.grid, dtype = bool)
+        keep[dst] = present.reshape(self.grid)[src]
+        keep &= (numpy.abs(shifted[0] - lattice[0]) <= self.cell[0]) & (numpy.abs(shifted[1] - lattice[1]) <= self.cell[1])
+        return [numpy.where(keep, new, old).ravel() for new, old in zip(shifted, lattice)]
+
+    def padded(self, center, fill):
+        # float32 center values over the padded lattice
+        padded = numpy.full((self.grid[0] + 2, self.grid[1] + 2), fill, dtype = numpy.float32)
+        padded[1:-1, 1:-1] = center.reshape(self.grid)
+        return padded.ravel()
+
+    def add_term(self, values, center, weight, first = False):
+        # weight * (values - center[index])^2 added to the candidate's distance (or stored, for the first term)
+        term = self.distance if first else self.term
+        numpy.take(center, self.index, out = term)
+        numpy.subtract(values, term, out = term)
+        numpy.multiply(term, term, out = term)
+        term *= weight
+        if not first:
+            self.distance += term
+
+    def assign(self, image, cy, cx, cv):
+        # label of the closest of the 9 candidate centers of every pixel (the first one on ties)
+        spatial = numpy.float32(1.0 / self.step ** 2)
+        color = numpy.float32(1.0 / self.compactness ** 2)
+        cy, cx, cv = self.padded(cy, numpy.inf), self.padded(cx, numpy.inf), self.padded(cv, 0)
+        for candidate, offset in enumerate(self.offsets):
+            numpy.add(self.cells, offset, out = self.index)
+            self.add_term(image, cv, color, first = True)
+            self.add_term(self.y, cy, spatial)
+            self.add_term(self.x, cx, spatial)
+            if candidate == 0:
+                numpy.copyto(self.best, self.distance)
+                numpy.copyto(self.nearest, self.index)
+            else:
+                numpy.less(self.distance, self.best, out = self.closer)
+                numpy.copyto(self.best, self.distance, where = self.closer)
+                numpy.copyto(self.nearest, self.index, where = self.closer)
+        return numpy.take(self.unpadded, self.nearest, out = self.labels)
+
+    def iterate(self, image, centers, iterations):
+        cy, cx, cv = centers
+        image = image.astype(numpy.float32)
+        for iteration in xrange(iterations):
+            labels = self.assign(image, cy, cx, cv)
+            flat = labels.ravel()
+            sizes = numpy.bincount(flat, minlength = len(cy))
+            present = sizes > 0
+            for center, values in ((cy, self.y), (cx, self.x), (cv, image)):
+                center[present] = numpy.bincount(flat, weights = values.ravel(), minlength = len(cy))[present] / sizes[present]
+        return labels, (cy, cx, cv), present
+
+    def segment(self, image):
+        image = numpy.asarray(image, dtype = numpy.float64)
+        if self.shape != image.shape[:2]:
+            self.allocate(image.shape[:2])
+            self.previous = None
+        small = block_mean(image, self.subsample)
+
+        warm = False
+        if self.previous is not None:
+            previous_small, centers, present = self.previous
+            shift = phase_correlation(previous_small, small) if self.motion else (0, 0)
+            warm = overlap_correlation(previous_small, small, shift) >= self.similarity
+        if warm:
+            self.warm_frames += 1
+            centers = self.shifted_centers(image, centers, present, (shift[0] * self.subsample, shift[1] * self.subsample))
+            labels, centers, present = self.iterate(image, centers, self.warm_iterations)
+        else:
+            self.cold_frames += 1
+            labels, centers, present = self.iterate(image, self.lattice_centers(image), self.iterations)
+        self.previous = (small, centers, present)
+        return compact_labels(enforce_connectivity(labels))[0]
+
+    def describe(self):
+        return "sequence(n_segments={}, compactness={}, iterations={}, warm_iterations={}, similarity={}, motion={})".format(self.n_segments, self.compactness, self.iterations, self.warm_iterations, self.similarity, self.motion)
+
+    def close(self):
+        pass
+
+BACKENDS = collections.OrderedDict([('slic', SlicBackend), ('tiled', TiledSlicBackend), ('grid', GridBackend), ('sequence', SequenceSlicBackend)])
+
+def add_arguments(ap):
+    ap.add_argument("-b", "--superpixels", required = False, help = "Superpixel backend: SLIC on the whole image, SLIC on overlapping tiles in parallel processes, a fixed grid lattice (fastest), or lattice SLIC warm-started from the previous frame of a sequence.", default = "slic", choices = list(BACKENDS.keys()))
+    ap.add_argument("--n-segments", required = False, help = "Approximate number of superpixels.", default = 35000, type = int)
+    ap.add_argument("--compactness", required = False, help = "SLIC compactness (slic, tiled and sequence backends).", default = 0.05, type = float)
+    ap.add_argument("--sigma", required = False, help = "SLIC Gaussian smoothing (slic and tiled backends).", default = 0, type = float)
+    ap.add_argument("--tiles", required = False, help = "Number of tile rows and columns (tiled backend).", default = [2, 2], nargs = 2, type = int)
+    ap.add_argument("--overlap", required = False, help = "Overlap margin of the tiles in pixels (tiled backend).", default = 16, type = int)
+    ap.add_argument("--processes", required = False, help = "Number of worker processes (tiled backend). Defaults to the number of cores.", type = int)
+    ap.add_argument("--warm-iterations", required = False, help = "Refinement iterations for frames seeded from the previous frame (sequence backend; cold starts use 10).", default = 3, type = argparse_help.positiveInt)
+    ap.add_argument("--similarity", required = False, help = "Minimum correlation with the previous frame for a warm start (sequence backend).", default = 0.8, type = argparse_help.ratioFloat)
+    ap.add_argument("--motion", required = False, help = "Shift the previous frame's centers by a global motion estimate (sequence backend).", action = "store_true")
+
+def from_args(args):
+    if args['superpixels'] == 'grid':
+        return GridBackend(args['n_segments'])
+    if args['superpixels'] == 'sequence':
+        return SequenceSlicBackend(args['n_segments'], args['compactness'], warm_iterations = args['warm_iterations'], similarity = args['similarity'], motion = args['motion'])
+    if args['superpixels'] == 'tiled':
+        return TiledSlicBackend(args['n_segments'], args['compactness'], args['sigma'], args['tiles'], args['overlap'], args['processes'])
+    return SlicBackend(args['n_segments'], args['compactness'], args['sigma'])
@@ -4,15 +4,33 @@
 # calculates the drop-out thresholds for all the superpixels according to a given model
 
 import numpy
+import profiling
 
 def superpixels_histograms(image, superpixels):
-    num_sp = len(numpy.unique(superpixels))    
-    hist = [[0]*256 for _ in xrange(num_sp)]
-    counter = 0
-    for (seg_val, px_val) in zip(numpy.nditer(superpixels, order = 'C'), numpy.nditer(image, order = 'C')):
-        hist[int(seg_val)][int(px_val)] += 1
-        counter += 1
-    return hist
+    # one 256-bin histogram per superpixel, as a (num_sp, 256) uint32 array. Row i belongs to the i-th
+    # smallest label id, so that label maps which are not numbered 0..n-1 are handled as well
+    labels = numpy.asarray(superpixels, dtype = numpy.intp).ravel()
+    sizes = numpy.bincount(labels)
+    if sizes.all():
+        num_sp = len(sizes)
+    else:
+        lookup = numpy.cumsum(sizes > 0) - 1
+        num_sp = lookup[-1] + 1
+        labels = lookup[labels]
+    bins = labels * 256
+    bins += numpy.asarray(image).ravel()
+    return numpy.bincount(bins, minlength = num_sp * 256).reshape(num_sp, 256).astype(numpy.uint32)
+
+def superpixel_ids(superpixels):
+    # label ids present in the label map, in the order of the histogram rows
+    return numpy.flatnonzero(numpy.bincount(numpy.asarray(superpixels).ravel()))
+
+def superpixels_moments(histograms):
+    # pixel count and first moment (sum of graylevels) of every superpixel
+    histograms = numpy.asarray(histograms)
+    counts = histograms.sum(axis = 1, dtype = numpy.int64)
+    moments = numpy.dot(histograms, numpy.arange(256, dtype = numpy.int64))
+    return counts, moments
 
 def k_percent_dot(histograms, k = 0.7, invert = False):
     thresholds = []
@@ -64,6 +82,45 @@ def median_dot(histograms, invert = False):
                 break
     return thresholds
 
+# array versions of the models: work on the whole (num_sp, 256) histogram matrix at once and return
+# a numpy array of drop-out thresholds. Superpixels for which the percentage model finds no threshold
+# (all pixels at 255, or at 0 when inverted) get 256 (-1 when inverted) instead of being skipped,
+# so the result stays aligned with the histogram rows; they are accepted for every threshold
+
+def k_percent_dot_array(histograms, k = 0.7, invert = False):
+    histograms = numpy.asarray(histograms)
+    hist_sum = histograms.sum(axis = 1, dtype = numpy.int64)
+    if not invert:
+        # candidate i = 1..255 tests the pixels below i
+        cum_sum = numpy.cumsum(histograms[:, :255], axis = 1, dtype = numpy.int64)
+    else:
+        # candidate i = 0..254 tests the pixels above i
+        cum_sum = numpy.cumsum(histograms[:, :0:-1], axis = 1, dtype = numpy.int64)[:, ::-1]
+    accepted = cum_sum / hist_sum[:, numpy.newaxis].astype(numpy.float64) > (1 - k)
+    found = accepted.any(axis = 1)
+    if not invert:
+        thresholds = numpy.argmax(accepted, axis = 1) + 1
+        thresholds[~found] = 256
+    else:
+        thresholds = 254 - numpy.argmax(accepted[:, ::-1], axis = 1)
+        thresholds[~found] = -1
+    return thresholds
+
+def average_dot_array(histograms, invert = False):
+    histograms = numpy.asarray(histograms)
+    hist_sum = histograms.sum(axis = 1, dtype = numpy.int64)
+    sum_weighted = numpy.dot(histograms.astype(numpy.int64), numpy.arange(256))
+    return sum_weighted // hist_sum
+
+def median_dot_array(histograms, invert = False):
+    histograms = numpy.asarray(histograms)
+    cum_sum = numpy.cumsum(histograms, axis = 1, dtype = numpy.int64) * 2
+    hist_sum = cum_sum[:, -1:] // 2
+    above = numpy.argmax(cum_sum > hist_sum, axis = 1)
+    # if exactly half of the pixels are at or below i, the median is between i and the next non-empty bin
+    half = numpy.argmax(cum_sum >= hist_sum, axis = 1)
+    return (half + above) // 2
+
 def dot_sort(single_dot, invert = False):
     dot_sorted = zip(single_dot, range(len(single_dot)))
     dot_sorted.sort()
@@ -95,3 +152,81 @@ def all_percent_dot(histograms, invert = False):
                 thresholds.append((1-float(prev_sum)/hist_sum, i, sp))
     return thresholds
 
+def all_percent_dot_array(histograms, invert = False):
+    # events (k, threshold, superpixel) of the percentage model as three arrays: for k from an event down to
+    # the next event of the same superpixel, k_percent_dot gives the superpixel that threshold. Besides the
+    # events of all_percent_dot, the k below which no threshold is found (256, or -1 when inverted) is included
+    histograms = numpy.asarray(histograms)
+    if invert: # the inverted model is the regular one on mirrored histograms
+        histograms = histograms[:, ::-1]
+    hist_sum = histograms.sum(axis = 1, dtype = numpy.int64).astype(numpy.float64)
+    cum_sum = numpy.cumsum(histograms, axis = 1, dtype = numpy.int64)
+
+    superpixels, thresholds = numpy.nonzero(histograms[:, 1:255])
+    ratios = cum_sum[superpixels, thresholds] / hist_sum[superpixels]
+    thresholds += 2
+
+    ratio_none = cum_sum[:, 254] / hist_sum
+    none = numpy.flatnonzero(ratio_none < 1)
+    ratios = numpy.concatenate((ratios, ratio_none[none]))
+    thresholds = numpy.concatenate((thresholds, numpy.full(len(none), 256, dtype = thresholds.dtype)))
+    superpixels = numpy.concatenate((superpixels, none))
+
+    # an event happens at the largest k for which k_percent_dot_array no longer accepts the previous
+    # threshold (ratio <= 1 - k); 1 - ratio is only within rounding of it
+    ks = 1 - ratios
+    late = 1 - ks < ratios
+    while late.any():
+        ks[late] = numpy.nextafter(ks[late], -numpy.inf)
+        late = 1 - ks < ratios
+    early = 1 - numpy.nextafter(ks, numpy.inf) >= ratios
+    while early.any():
+        ks[early] = numpy.nextafter(ks[early], numpy.inf)
+        early = 1 - numpy.nextafter(ks, numpy.inf) >= ratios
+
+    if invert:
+        thresholds = 255 - thresholds
+    return ks, thresholds, superpixels
+
+class SuperpixelStats(object):
+    # statistics of the superpixels of one 8-bit frame: the label map, histogram matrix, pixel counts and first
+    # moments, and the DOTs of the models used on the frame. Built once per frame and shared by the threshold,
+    # recency correction and mask steps, so that re-thresholding at a new T only costs the mask
+
+    @profiling.timed('histogram')
+    def __init__(self, image, superpixels):
+        self.superpixels = numpy.asarray(superpixels)
+        self.histograms = superpixels_histograms(image, self.superpixels)
+        self.counts, self.moments = superpixels_moments(self.histograms)
+        self.total = self.superpixels.shape[0] * self.superpixels.shape[1]
+        self.sum_all = self.moments.sum()
+        # label ids of the histogram rows, only kept for label maps not numbered 0..n-1
+        self.ids = None
+        if len(self.histograms) != self.superpixels.max() + 1:
+            self.ids = superpixel_ids(self.superpixels)
+        self.dots = {}
+        self.events = {}
+
+    def __len__(self):
+        return len(self.histograms)
+
+    def dot(self, dot_function, invert = False):
+        key = (dot_function, invert)
+        if key not in self.dots:
+            with profiling.stage('dot'):
+                self.dots[key] = numpy.asarray(dot_function(self.histograms, invert = invert))
+        return self.dots[key]
+
+    def percent_events(self, invert = False):
+        if invert not in self.events:
+            with profiling.stage('dot'):
+                self.events[invert] = all_percent_dot_array(self.histograms, invert)
+        return self.events[invert]
+
+    def label_lookup(self, values):
+        # per-superpixel values (or rows) as a table indexed by label id
+        if self.ids is None:
+            return values
+        lookup = numpy.zeros((self.ids[-1] + 1,) + values.shape[1:], dtype = values.dtype)
+        lookup[self.ids] = values
+        return lookup
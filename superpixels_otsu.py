@@ -3,210 +3,314 @@
 
 # implementation of Otsu's method on superpixels. Uses a pixel model based on which the drop-out thresholds for each superpixel are calculated
 
-import superpixels_dot # for dot_sorted
+import superpixels_dot
+import profiling
 import numpy
 
 from functools import partial
 
-def otsu_core(image, histograms, dot, invert = False, verbose = False):
-    dot_sorted = superpixels_dot.dot_sort(dot, invert)
-
-#    sum_all = 0
-    
-    sum_all = sum([i*hist[i] for hist in histograms for i in xrange(1, 256)])
-
-#    for hist in histograms:
-#        for i in xrange(1, 256):
-#            sum_all += i*hist[i]
-
-    wB = 0
-    sumB = 0
-    var_max = 0
-
-    current_superpixel = 0
-    if not invert:
-        iterRange = xrange(0, 256)
-    else:
-        iterRange = xrange(255, -1, -1)
-
-    all_var = [0]*256
-
-    for thresh in iterRange:
-        while current_superpixel < len(dot_sorted) and dot_sorted[current_superpixel][0] == thresh:
-            wB += sum(histograms[dot_sorted[current_superpixel][1]])
-            sumB += sum([i*histograms[dot_sorted[current_superpixel][1]][i] for i in xrange(1,256)])
-#            for i in xrange(1, 256):
-#                sumB += i*histograms[dot_sorted[current_superpixel][1]][i]
-            current_superpixel += 1
-        if wB == 0:
-            continue
-        wF = image.shape[0] * image.shape[1] - wB
-        if wF == 0:
-            break
-
-        mB = sumB / wB
-        mF = (sum_all - sumB) / wF
-        
-        all_var[thresh] = float(wB) * float(wF) * ((mB - mF)**2)
+def threshold_buckets(dot, counts, moments):
+    # pixel counts and first moments of the superpixels joining the background at each threshold
+    # (superpixels with a DOT outside [0, 255] never join the background)
+    dot = numpy.asarray(dot)
+    joining = (dot >= 0) & (dot <= 255)
+    count_buckets = numpy.bincount(dot[joining], weights = counts[joining], minlength = 256).astype(numpy.int64)
+    moment_buckets = numpy.bincount(dot[joining], weights = moments[joining], minlength = 256).astype(numpy.int64)
+    return count_buckets, moment_buckets
+
+def otsu_variance(total, sum_all, count_buckets, moment_buckets, invert = False):
+    # between-class variance for every threshold, from cumulative sums of the buckets in the order the
+    # thresholds are visited; integer (floor) class means and the stop at wF == 0 follow the per-threshold loop
+    order = slice(None, None, -1) if invert else slice(None)
+    wB = numpy.cumsum(count_buckets[order])
+    sumB = numpy.cumsum(moment_buckets[order])
+    wF = total - wB
+    mB = sumB // numpy.maximum(wB, 1)
+    mF = (sum_all - sumB) // numpy.where(wF == 0, 1, wF)
+    all_var = wB.astype(numpy.float64) * wF.astype(numpy.float64) * ((mB - mF)**2)
+    all_var[wB == 0] = 0
+    all_var[numpy.cumsum(wF == 0) > 0] = 0
+    return all_var[order]
+
+def best_threshold(all_var, invert = False):
+    # first threshold with the largest variance, in the order the thresholds are visited
+    order = slice(None, None, -1) if invert else slice(None)
+    best = int(numpy.argmax(all_var[order]))
+    var_max = all_var[order][best]
+    if var_max == 0:
+        return 0, 0
+    return var_max, (255 - best if invert else best)
 
-        if all_var[thresh] > var_max:
-            var_max = all_var[thresh]
-            threshold = thresh
+@profiling.timed('otsu')
+def otsu_core(stats, dot, invert = False, verbose = False):
+    # Otsu's threshold over the superpixels joining the background at their DOTs, from the per-threshold
+    # buckets of the frame statistics (a superpixels_dot.SuperpixelStats)
+    count_buckets, moment_buckets = threshold_buckets(dot, stats.counts, stats.moments)
 
-    if var_max == 0:
-        threshold = 0
+    all_var = otsu_variance(stats.total, stats.sum_all, count_buckets, moment_buckets, invert)
+    var_max, threshold = best_threshold(all_var, invert)
 
     if verbose:
         print("Otsu's thresholding for superpixels: best threshold={} for variance={}.".format(threshold, var_max))
 
     return var_max, threshold, all_var
 
-def otsu_reduced_core(image, dot, invert = False, verbose = False):
-    dot_sorted = superpixels_dot.dot_sort(dot, invert)
+def reduced_buckets(dot):
+    # every superpixel counts as a single pixel with its DOT as graylevel (a DOT of 256 falls in the last bin)
+    dot = numpy.asarray(dot)
+    count_buckets = numpy.bincount(numpy.minimum(dot[(dot >= 0) & (dot <= 256)], 255), minlength = 256).astype(numpy.int64)
+    moment_buckets = count_buckets * numpy.arange(256)
+    return count_buckets, moment_buckets
 
-    total = len(dot)
-    dot_histogram = numpy.histogram(dot, range = [0, 256], bins = 256)[0]
-    
-    sumB = 0
-    wB = 0
-    var_max = 0.0
-    #print(dot_histogram)
-    #print(type(dot_histogram))
-    sum_all = numpy.dot(range(0, len(dot_histogram)), dot_histogram)
+@profiling.timed('otsu')
+def otsu_reduced_core(stats, dot, invert = False, verbose = False):
+    count_buckets, moment_buckets = reduced_buckets(dot)
 
-    if not invert:
-        iterRange = xrange(0, 256)
-    else:
-        iterRange = xrange(255, -1, -1)
-
-    all_var = [0]*256
-
-    for thresh in iterRange:
-        wB += dot_histogram[thresh]
-        if wB == 0:
-            continue
-        wF = total - wB
-        if wF == 0:
-            break
-        sumB += thresh*dot_histogram[thresh]
-        mB = sumB / wB
-        mF = (sum_all - sumB) / wF
-        
-        all_var[thresh] = float(wB) * float(wF) * ((mB - mF)**2)
-
-        if all_var[thresh] > var_max:
-            var_max = all_var[thresh]
-            threshold = thresh
-
-    if var_max == 0:
-        threshold = 0
+    all_var = otsu_variance(len(stats), moment_buckets.sum(), count_buckets, moment_buckets, invert)
+    var_max, threshold = best_threshold(all_var, invert)
 
     if verbose:
         print("Otsu's reduced thresholding for superpixels: best threshold={} for variance={}.".format(threshold, var_max))
 
     return var_max, threshold, all_var
 
+def accepted_superpixels(dot, threshold, invert = False):
+    # number of superpixels accepted at the threshold
+    return numpy.count_nonzero(dot < threshold if invert else dot > threshold)
 
-def otsu_mask(superpixels, dot, threshold, invert = False, verbose = False):
-
-    dot_sorted = superpixels_dot.dot_sort(dot, invert)
-
-    accepted = []
-    current_superpixel = len(dot_sorted)-1
+def print_accepted(dot, threshold, invert = False):
+    print("Accepted {} out of {} superpixels".format(accepted_superpixels(dot, threshold, invert), len(dot)))
 
-    while current_superpixel >= 0 and ((invert == False and dot_sorted[current_superpixel][0] > threshold) or (invert == True and dot_sorted[current_superpixel][0] < threshold)):       
-        accepted.append(dot_sorted[current_superpixel][1])
-        current_superpixel -= 1
+@profiling.timed('mask')
+def otsu_mask(stats, dot, threshold, invert = False, verbose = False, out = None):
+    # 255 for the superpixels whose DOT is above the threshold (below if inverted), as a lookup over label
+    # ids gathered through the label map. out can be a uint8 buffer reused between calls, replaced by a new one
+    # when it does not have the label map's shape
+    dot = numpy.asarray(dot)
+    if not invert:
+        accepted = dot > threshold
+    else:
+        accepted = dot < threshold
 
     if verbose:
-        print("Accepted {} out of {} superpixels".format(len(accepted), len(dot_sorted)))
-
-    mask = numpy.zeros(superpixels.shape[:2], dtype = "uint8")
-    mask[numpy.in1d(superpixels, accepted).reshape(mask.shape)] = 255
+        print_accepted(dot, threshold, invert)
+
+    accept = stats.label_lookup(accepted.astype(numpy.uint8) * numpy.uint8(255))
+    if out is None or out.shape != stats.superpixels.shape[:2]:
+        out = numpy.empty(stats.superpixels.shape[:2], dtype = numpy.uint8)
+    return numpy.take(accept, stats.superpixels, out = out, mode = 'clip')
+
+def move_buckets(count_buckets, moment_buckets, old_dot, new_dot, counts, moments):
+    for dot, sign in ((old_dot, -1), (new_dot, 1)):
+        joining = (dot >= 0) & (dot <= 255)
+        numpy.add.at(count_buckets, dot[joining], sign * counts[joining])
+        numpy.add.at(moment_buckets, dot[joining], sign * moments[joining])
+
+@profiling.timed('otsu')
+def otsu_percentage_sweep(stats, invert = False, k_start = 0.2, k_end = 0.8):
+    # Otsu's threshold for the percentage model at every distinct k of the events (see all_percent_dot_array)
+    # in [k_start, k_end], visited from k_end down. Only the superpixels whose DOT changes at a k update the
+    # per-threshold buckets, and the variance curve is recomputed from the buckets. The events are kept in the
+    # frame statistics, so widening the window reuses them. Returns the per-k trace (ks, variances, thresholds)
+    counts, moments = stats.counts, stats.moments
+    ks, thresholds, superpixels = stats.percent_events(invert)
+    order = numpy.argsort(-ks, kind = 'mergesort')
+    ks_sorted = ks[order]
+
+    # DOTs at k_end: the last event above k_end of every superpixel
+    dot_cur = numpy.full(len(counts), 254 if invert else 1, dtype = numpy.int64)
+    above = numpy.searchsorted(-ks_sorted, -k_end, side = 'left')
+    if above:
+        last = order[:above][::-1]
+        changed, first = numpy.unique(superpixels[last], return_index = True)
+        dot_cur[changed] = thresholds[last[first]]
+    count_buckets, moment_buckets = threshold_buckets(dot_cur, counts, moments)
+
+    starts = above + numpy.flatnonzero(numpy.diff(numpy.concatenate(([numpy.nan], ks_sorted[above:]))) != 0)
+    ends = numpy.append(starts[1:], len(ks_sorted))
+
+    trace_k, trace_var, trace_thr = [], [], []
+    for start, end in zip(starts, ends):
+        k = ks_sorted[start]
+        if k < k_start:
+            break
+        batch = order[start:end]
+        changed = superpixels[batch]
+        move_buckets(count_buckets, moment_buckets, dot_cur[changed], thresholds[batch], counts[changed], moments[changed])
+        dot_cur[changed] = thresholds[batch]
 
-    return mask
+        var, thr = best_threshold(otsu_variance(stats.total, stats.sum_all, count_buckets, moment_buckets, invert), invert)
+        trace_k.append(k)
+        trace_var.append(var)
+        trace_thr.append(thr)
 
-def otsu_superpixels_precentage(image, superpixels, invert = False, verbose = False, k_start = 0.2, k_end = 0.8):
-    histograms = superpixels_dot.superpixels_histograms(image, superpixels)
+    return numpy.array(trace_k), numpy.array(trace_var, dtype = numpy.float64), numpy.array(trace_thr, dtype = numpy.int64)
 
-    mult = 1
-    if invert:
-        mult = -1
+def otsu_superpixels_precentage(image, superpixels, invert = False, verbose = False, k_start = 0.2, k_end = 0.8, stats = None, out = None):
+    if stats is None:
+        stats = superpixels_dot.SuperpixelStats(image, superpixels)
 
-    all_thr = sorted(superpixels_dot.all_precent_dot(histograms, invert), key = lambda t:(-t[0]*mult, mult*t[1])) # do I even need t[1] or is it unique
+    trace = otsu_percentage_sweep(stats, invert, k_start, k_end)
+    ks, variances, thresholds = trace
 
-    if not invert: #check the initialization
-        dot_cur = [1] * len(histograms)
-    else:
-        dot_cur = [254] * len(histograms)
-    
-    i = 0
     var_max = 0
     threshold = 0
     k_best = 0
-
-    tests = 0
-    while i < len(all_thr):
-        k = all_thr[i][0]
-        while i < len(all_thr) and all_thr[i][0] == k:
-            dot_cur[all_thr[i][2]] = all_thr[i][1]
-            i += 1
-        if (k < k_start):
-            continue
-        if (k > k_end):
-            break
-        tests += 1
-        var, thr = otsu_core(image, histograms, dot_cur, invert, verbose)[:2]
+    for test, (k, var, thr) in enumerate(zip(ks, variances, thresholds)):
         if verbose:
-            print("Test # {} with k={}, output var={}, thr={} (best var={} for thr={} at k={}).".format(tests, k, var, thr, var_max, threshold, k_best))
+            print("Test # {} with k={}, output var={}, thr={} (best var={} for thr={} at k={}).".format(test + 1, k, var, thr, var_max, threshold, k_best))
         if var > var_max:
             var_max = var
             threshold = thr
             k_best = k
 
     if verbose:
-        print("Otsu for all k on superpixels found: best k={}, threshold={} (while doing {} tests)".format(k_best, threshold, tests))
+        print("Otsu for all k on superpixels found: best k={}, threshold={} (while doing {} tests)".format(k_best, threshold, len(ks)))
+
+    dot = stats.dot(partial(superpixels_dot.k_percent_dot_array, k = k_best), invert)
+    mask = otsu_mask(stats, dot, threshold, invert, verbose, out)
+
+    return threshold, mask, k_best, trace
+
+# multi-level Otsu: num_thresholds thresholds split the superpixels into num_thresholds + 1 classes, class 0
+# joining the background first (lowest DOTs, highest if inverted) and the last class holding the accepted ones
+
+def cumulative_tables(total, sum_all, count_buckets, moment_buckets, invert = False):
+    # cumulative counts and moments at the 258 class boundaries in the order the thresholds are visited: the
+    # start, after each threshold, and the end (which includes the superpixels that never join the background)
+    order = slice(None, None, -1) if invert else slice(None)
+    cum_counts = numpy.concatenate(([0], numpy.cumsum(count_buckets[order]), [total])).astype(numpy.float64)
+    cum_moments = numpy.concatenate(([0], numpy.cumsum(moment_buckets[order]), [sum_all])).astype(numpy.float64)
+    return cum_counts, cum_moments
+
+def multi_threshold_search(cum_counts, cum_moments, num_thresholds = 2, invert = False):
+    # the between-class variance is a sum of moment^2 / count over the classes, so the best thresholds are
+    # found by chaining one vectorized (258, 258) maximization per threshold over the table of class terms
+    # terms[a, b] of the class between boundaries a and b (-inf for empty classes)
+    if num_thresholds < 1:
+        raise ValueError("At least one threshold is needed, got {}.".format(num_thresholds))
+    counts = cum_counts[numpy.newaxis, :] - cum_counts[:, numpy.newaxis]
+    moments = cum_moments[numpy.newaxis, :] - cum_moments[:, numpy.newaxis]
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        terms = moments * moments / counts
+    terms[counts <= 0] = -numpy.inf
+    end = len(cum_counts) - 1
+
+    # best[b]: best sum of the class terms up to boundary b, for a threshold placed at b
+    best = terms[0].copy()
+    best[[0, end]] = -numpy.inf
+    previous = []
+    for level in xrange(num_thresholds - 1):
+        candidates = best[:, numpy.newaxis] + terms
+        previous.append(numpy.argmax(candidates, axis = 0))
+        best = candidates[previous[-1], numpy.arange(len(best))]
+        best[[0, end]] = -numpy.inf
+    best += terms[:, end]
+
+    boundary = int(numpy.argmax(best))
+    if best[boundary] == -numpy.inf: # fewer non-empty buckets than classes
+        return 0, [0] * num_thresholds
+    boundaries = [boundary]
+    for level in reversed(previous):
+        boundaries.append(int(level[boundaries[-1]]))
+    total, sum_all = cum_counts[end], cum_moments[end]
+    var_max = (best[boundary] - sum_all * sum_all / total) / total
+    # boundary b follows the (b - 1)-th visited threshold
+    thresholds = [255 - (b - 1) if invert else b - 1 for b in reversed(boundaries)]
+    return var_max, thresholds
+
+@profiling.timed('otsu')
+def otsu_multi_core(stats, dot, num_thresholds = 2, invert = False, verbose = False):
+    # thresholds are returned in the order they are visited (descending if inverted), with the between-class variance
+    count_buckets, moment_buckets = threshold_buckets(dot, stats.counts, stats.moments)
+    cum_counts, cum_moments = cumulative_tables(stats.total, stats.sum_all, count_buckets, moment_buckets, invert)
+    var_max, thresholds = multi_threshold_search(cum_counts, cum_moments, num_thresholds, invert)
+
+    if verbose:
+        print("Multi-level Otsu's thresholding for superpixels: best thresholds={} for variance={}.".format(thresholds, var_max))
+
+    return var_max, thresholds
+
+@profiling.timed('otsu')
+def otsu_multi_reduced_core(stats, dot, num_thresholds = 2, invert = False, verbose = False):
+    count_buckets, moment_buckets = reduced_buckets(dot)
+    cum_counts, cum_moments = cumulative_tables(len(stats), moment_buckets.sum(), count_buckets, moment_buckets, invert)
+    var_max, thresholds = multi_threshold_search(cum_counts, cum_moments, num_thresholds, invert)
+
+    if verbose:
+        print("Multi-level Otsu's reduced thresholding for superpixels: best thresholds={} for variance={}.".format(thresholds, var_max))
 
-    if not invert: #check the initialization like above
-        dot_cur = [1] * len(histograms)
+    return var_max, thresholds
+
+@profiling.timed('mask')
+def otsu_multi_mask(stats, dot, thresholds, invert = False, verbose = False, out = None):
+    # (height, width, num_thresholds + 1) uint8 array with the 0/255 mask of class c in [..., c], gathered
+    # from a per-label table in one pass over the label map. out can be reused between calls
+    dot = numpy.asarray(dot)
+    if not invert:
+        classes = numpy.searchsorted(numpy.sort(thresholds), dot, side = 'left')
     else:
-        dot_cur = [254] * len(histograms)
-    i = 0
-    while i < len(all_thr) and all_thr[i][0] != k:
-        dot_cur[all_thr[i][2]] = all_thr[i][1]
-        i += 1
-    while i < len(all_thr) and all_thr[i][0] == k:
-        dot_cur[all_thr[i][2]] = all_thr[i][1]
-        i += 1
+        classes = numpy.searchsorted(-numpy.sort(thresholds)[::-1], -dot, side = 'left')
+    num_classes = len(thresholds) + 1
+
+    if verbose:
+        print("Superpixels per class: {}".format(numpy.bincount(classes, minlength = num_classes).tolist()))
 
-    mask = otsu_mask(superpixels, dot_cur, threshold, invert, verbose)
+    table = numpy.zeros((len(dot), num_classes), dtype = numpy.uint8)
+    table[numpy.arange(len(dot)), classes] = 255
+    table = stats.label_lookup(table)
+    if out is None:
+        out = numpy.empty(stats.superpixels.shape[:2] + (num_classes,), dtype = numpy.uint8)
+    return numpy.take(table, stats.superpixels, axis = 0, out = out, mode = 'clip')
 
-    return threshold, mask, k_best
+# the wrappers below take an optional superpixels_dot.SuperpixelStats of the frame (built from image and
+# superpixels when not given), so that several calls on one frame share the histograms and DOTs
 
-def otsu_superpixels_fixed_dot(image, superpixels, invert = False, dot_function = partial(superpixels_dot.k_percent_dot, k = 0.7), verbose = False):        
-    histograms = superpixels_dot.superpixels_histograms(image, superpixels)
-#    dot = drop_out_thresholds(histograms, k, invert)  # or any other way to get drop-out-thresholds -> should maybe 
-#    dot = median_thresholds(histograms, invert)
-    dot = dot_function(histograms, invert = invert)
+def otsu_superpixels_fixed_dot(image, superpixels, invert = False, dot_function = partial(superpixels_dot.k_percent_dot_array, k = 0.7), verbose = False, stats = None, out = None):
+    if stats is None:
+        stats = superpixels_dot.SuperpixelStats(image, superpixels)
+    dot = stats.dot(dot_function, invert)
 
-    var_max, threshold, all_var = otsu_core(image, histograms, dot, invert, verbose)
-    mask = otsu_mask(superpixels, dot, threshold, invert, verbose)
+    var_max, threshold, all_var = otsu_core(stats, dot, invert, verbose)
+    mask = otsu_mask(stats, dot, threshold, invert, verbose, out)
 
     return threshold, mask, all_var
 
-def otsu_superpixels_reduced_fixed_dot(image, superpixels, invert = False, dot_function = partial(superpixels_dot.k_percent_dot, k = 0.7), verbose = False):
-    dot = dot_function(superpixels_dot.superpixels_histograms(image, superpixels), invert = invert)
+def otsu_superpixels_reduced_fixed_dot(image, superpixels, invert = False, dot_function = partial(superpixels_dot.k_percent_dot_array, k = 0.7), verbose = False, stats = None, out = None):
+    if stats is None:
+        stats = superpixels_dot.SuperpixelStats(image, superpixels)
+    dot = stats.dot(dot_function, invert)
 
-    var_max, threshold, all_var = otsu_reduced_core(image, dot, invert, verbose)
-    mask = otsu_mask(superpixels, dot, threshold, invert, verbose)
+    var_max, threshold, all_var = otsu_reduced_core(stats, dot, invert, verbose)
+    mask = otsu_mask(stats, dot, threshold, invert, verbose, out)
 
     return threshold, mask, all_var
 
-def otsu_only_mask(image, superpixels, threshold, invert = False, dot_function = partial(superpixels_dot.k_percent_dot, k = 0.7), verbose = False):
-
-    histograms = superpixels_dot.superpixels_histograms(image, superpixels)
-    dot = dot_function(superpixels_dot.superpixels_histograms(image, superpixels), invert = invert)
+def otsu_only_mask(image, superpixels, threshold, invert = False, dot_function = partial(superpixels_dot.k_percent_dot_array, k = 0.7), verbose = False, stats = None, out = None):
+    if stats is None:
+        stats = superpixels_dot.SuperpixelStats(image, superpixels)
+    dot = stats.dot(dot_function, invert)
 
-    mask = otsu_mask(superpixels, dot, threshold, invert, verbose)
+    mask = otsu_mask(stats, dot, threshold, invert, verbose, out)
 
     return threshold, mask
+
+def otsu_superpixels_multi_fixed_dot(image, superpixels, num_thresholds = 2, invert = False, dot_function = partial(superpixels_dot.k_percent_dot_array, k = 0.7), verbose = False, stats = None):
+    if stats is None:
+        stats = superpixels_dot.SuperpixelStats(image, superpixels)
+    dot = stats.dot(dot_function, invert)
+
+    var_max, thresholds = otsu_multi_core(stats, dot, num_thresholds, invert, verbose)
+    masks = otsu_multi_mask(stats, dot, thresholds, invert, verbose)
+
+    return thresholds, masks, var_max
+
+def otsu_superpixels_multi_reduced_fixed_dot(image, superpixels, num_thresholds = 2, invert = False, dot_function = partial(superpixels_dot.k_percent_dot_array, k = 0.7), verbose = False, stats = None):
+    if stats is None:
+        stats = superpixels_dot.SuperpixelStats(image, superpixels)
+    dot = stats.dot(dot_function, invert)
+
+    var_max, thresholds = otsu_multi_reduced_core(stats, dot, num_thresholds, invert, verbose)
+    masks = otsu_multi_mask(stats, dot, thresholds, invert, verbose)
+
+    return thresholds, masks, var_max
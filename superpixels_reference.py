@@ -0,0 +1,219 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# frozen reference implementation of the superpixel models and Otsu's method on superpixels: the original
+# pure-Python code of superpixels_dot.py and superpixels_otsu.py, kept unchanged as the definition of the
+# results (integer class means, strict '> 1 - k' test, median tie averaging, stop at wF == 0) that the
+# accelerated implementations must reproduce. Checked against them by differential.py; do not optimize.
+# The histograms are lists indexed by label, so label maps must be numbered 0..n-1. The original percentage
+# wrapper (which called a misspelled function) is not kept: the sweep is checked k by k with k_percent_dot
+
+import numpy
+
+def superpixels_histograms(image, superpixels):
+    num_sp = len(numpy.unique(superpixels))    
+    hist = [[0]*256 for _ in xrange(num_sp)]
+    counter = 0
+    for (seg_val, px_val) in zip(numpy.nditer(superpixels, order = 'C'), numpy.nditer(image, order = 'C')):
+        hist[int(seg_val)][int(px_val)] += 1
+        counter += 1
+    return hist
+
+def k_percent_dot(histograms, k = 0.7, invert = False):
+    thresholds = []
+    for hist in histograms:
+        hist_sum = sum(hist)
+
+        if not invert:
+            iterRange =  xrange(1, 256)
+            cum_sum = numpy.cumsum(hist)
+        else:
+            iterRange = xrange(254, -1, -1)
+            cum_sum = numpy.cumsum(hist[::-1])[::-1]
+        for i in iterRange:
+            if not invert:
+                cur_sum = cum_sum[i-1]
+            else:
+                cur_sum = cum_sum[i+1]
+            if float(cur_sum) / hist_sum > (1 - k):
+                thresholds.append(i)
+                break
+    return thresholds
+
+def average_dot(histograms, invert = False):
+    thresholds = []
+    for hist in histograms:
+        hist_sum = sum(hist)
+        sum_weighted = 0
+        for i in xrange(1, 256):
+            sum_weighted += i*hist[i]
+        thresholds.append(sum_weighted/hist_sum)
+    return thresholds
+
+def median_dot(histograms, invert = False):
+    thresholds = []
+    superpixel = 0
+    for hist in histograms:
+        superpixel += 1
+        hist_sum = sum(hist)
+        cum_sum = numpy.cumsum(hist)
+        for i in xrange(0, 256):
+            if cum_sum[i]*2 > hist_sum:
+                thresholds.append(i)
+                break
+            elif cum_sum[i]*2 == hist_sum:
+                for j in xrange(i+1, 256):
+                    if hist[j] > 0:
+                        thresholds.append((i+j)/2)                
+                        break
+                break
+    return thresholds
+
+def dot_sort(single_dot, invert = False):
+    dot_sorted = zip(single_dot, range(len(single_dot)))
+    dot_sorted.sort()
+    if invert:
+        dot_sorted.reverse()
+    return dot_sorted
+
+def all_percent_dot(histograms, invert = False):
+    thresholds = []
+    for hist, sp in zip(histograms, range(len(histograms))):
+        hist_sum = sum(hist)
+
+        if not invert:
+            iterRange =  xrange(1, 256)
+            cum_sum = numpy.cumsum(hist)
+        else:
+            iterRange = xrange(254, -1, -1)
+            cum_sum = numpy.cumsum(hist[::-1])[::-1]
+
+        
+        for i in iterRange:
+            if i != iterRange[0]:
+                prev_sum = cur_sum
+            if not invert:
+                cur_sum = cum_sum[i-1]
+            else:
+                cur_sum = cum_sum[i+1]
+            if i != iterRange[0] and prev_sum != cur_sum:
+                thresholds.append((1-float(prev_sum)/hist_sum, i, sp))
+    return thresholds
+
+def otsu_core(image, histograms, dot, invert = False, verbose = False):
+    dot_sorted = dot_sort(dot, invert)
+
+#    sum_all = 0
+    
+    sum_all = sum([i*hist[i] for hist in histograms for i in xrange(1, 256)])
+
+#    for hist in histograms:
+#        for i in xrange(1, 256):
+#            sum_all += i*hist[i]
+
+    wB = 0
+    sumB = 0
+    var_max = 0
+
+    current_superpixel = 0
+    if not invert:
+        iterRange = xrange(0, 256)
+    else:
+        iterRange = xrange(255, -1, -1)
+
+    all_var = [0]*256
+
+    for thresh in iterRange:
+        while current_superpixel < len(dot_sorted) and dot_sorted[current_superpixel][0] == thresh:
+            wB += sum(histograms[dot_sorted[current_superpixel][1]])
+            sumB += sum([i*histograms[dot_sorted[current_superpixel][1]][i] for i in xrange(1,256)])
+#            for i in xrange(1, 256):
+#                sumB += i*histograms[dot_sorted[current_superpixel][1]][i]
+            current_superpixel += 1
+        if wB == 0:
+            continue
+        wF = image.shape[0] * image.shape[1] - wB
+        if wF == 0:
+            break
+
+        mB = sumB / wB
+        mF = (sum_all - sumB) / wF
+        
+        all_var[thresh] = float(wB) * float(wF) * ((mB - mF)**2)
+
+        if all_var[thresh] > var_max:
+            var_max = all_var[thresh]
+            threshold = thresh
+
+    if var_max == 0:
+        threshold = 0
+
+    if verbose:
+        print("Otsu's thresholding for superpixels: best threshold={} for variance={}.".format(threshold, var_max))
+
+    return var_max, threshold, all_var
+
+def otsu_reduced_core(image, dot, invert = False, verbose = False):
+    dot_sorted = dot_sort(dot, invert)
+
+    total = len(dot)
+    dot_histogram = numpy.histogram(dot, range = [0, 256], bins = 256)[0]
+    
+    sumB = 0
+    wB = 0
+    var_max = 0.0
+    #print(dot_histogram)
+    #print(type(dot_histogram))
+    sum_all = numpy.dot(range(0, len(dot_histogram)), dot_histogram)
+
+    if not invert:
+        iterRange = xrange(0, 256)
+    else:
+        iterRange = xrange(255, -1, -1)
+
+    all_var = [0]*256
+
+    for thresh in iterRange:
+        wB += dot_histogram[thresh]
+        if wB == 0:
+            continue
+        wF = total - wB
+        if wF == 0:
+            break
+        sumB += thresh*dot_histogram[thresh]
+        mB = sumB / wB
+        mF = (sum_all - sumB) / wF
+        
+        all_var[thresh] = float(wB) * float(wF) * ((mB - mF)**2)
+
+        if all_var[thresh] > var_max:
+            var_max = all_var[thresh]
+            threshold = thresh
+
+    if var_max == 0:
+        threshold = 0
+
+    if verbose:
+        print("Otsu's reduced thresholding for superpixels: best threshold={} for variance={}.".format(threshold, var_max))
+
+    return var_max, threshold, all_var
+
+
+def otsu_mask(superpixels, dot, threshold, invert = False, verbose = False):
+
+    dot_sorted = dot_sort(dot, invert)
+
+    accepted = []
+    current_superpixel = len(dot_sorted)-1
+
+    while current_superpixel >= 0 and ((invert == False and dot_sorted[current_superpixel][0] > threshold) or (invert == True and dot_sorted[current_superpixel][0] < threshold)):       
+        accepted.append(dot_sorted[current_superpixel][1])
+        current_superpixel -= 1
+
+    if verbose:
+        print("Accepted {} out of {} superpixels".format(len(accepted), len(dot_sorted)))
+
+    mask = numpy.zeros(superpixels.shape[:2], dtype = "uint8")
+    mask[numpy.in1d(superpixels, accepted).reshape(mask.shape)] = 255
+
+    return mask
@@ -7,18 +7,25 @@ import matplotlib
 
 import argparse
 
+import results_io
+
 def main():
 
     ap = argparse.ArgumentParser(description = "Display the evolution of thresholds for an image sequence contained in a text file.")
 
-    ap.add_argument("-i", "--input", required = True, help = "Path to the file containing the results of Otsu's thresholding for an image sequence.")
+    ap.add_argument("-i", "--input", required = True, help = "Path to the file containing the results of Otsu's thresholding for an image sequence: the text output of a script, or a structured results file (.csv, .jsonl or .npz).")
+    ap.add_argument("-m", "--method", required = False, help = "Method whose thresholds are shown, from a structured results file with several methods. All of them by default.", choices = ["regular", "sp", "reduced"])
+    ap.add_argument("--raw", required = False, help = "Show the thresholds before the recency correction, from a structured results file.", action = "store_true")
 
     args = vars(ap.parse_args())
 
-    y = np.loadtxt(args["input"], unpack='False')
+    y, methods = results_io.load_thresholds(args["input"], args["method"], 'threshold' if args["raw"] else 'threshold_corrected')
     x = np.linspace(0, y.shape[0], y.shape[0]) 
 
-    plt.plot(x,y)
+    lines = plt.plot(x,y)
+    if methods:
+        for line, method in zip(lines, methods):
+            line.set_label(method)
     plt.ylim(ymax = 255, ymin = 0)
     plt.ylabel('Threshold')
     plt.xlabel('# image in sequence')